@@ -0,0 +1,97 @@
+#   Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+
+#       http://www.apache.org/licenses/LICENSE-2.0
+
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+from os.path import expanduser
+
+DEFAULT_CACHE_DIRECTORY = expanduser("~") + '/.iamctl/cache'
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+
+class DiffCache:
+    # Content addressed store for the Differ: entries are pickles named by the sha256
+    # of everything they were computed from, so they never need to be invalidated.
+    # When the directory grows over max_size the least recently used entries are removed.
+
+    def __init__(self, directory = None, max_size = DEFAULT_CACHE_SIZE):
+        self.logger = logging.getLogger(__name__)
+        self.directory = directory or DEFAULT_CACHE_DIRECTORY
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok = True)
+
+    def key(self, *parts):
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def hash_file(self, f):
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            digest.update(chunk.encode('utf-8'))
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def get(self, key):
+        entry_path = self.entry_path(key)
+        try:
+            with open(entry_path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            self.logger.warning("Dropping unreadable cache entry %s", entry_path)
+            os.remove(entry_path)
+            return None
+        # Eviction goes by modification time, touching marks the entry as recently used.
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            # Evicted by another diff since it was read, the value is still good.
+            pass
+        return value
+
+    def put(self, key, value):
+        # Write to a temporary file first so a concurrent reader never sees a partial entry.
+        fd, temp_path = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.entry_path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pickle'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.logger.info("Evicted cache entry %s", name)
@@ -29,11 +29,39 @@ from colorama import init,Fore, Back, Style
 from terminaltables import SingleTable
 from os.path import expanduser
 from os import path
+from iamctl.sink import LocalSink, writing
+
+# Part of every cache key, bump it when the sanitized items or the diff results change shape.
+CACHE_VERSION = 'differ-2'
+SERVICE_ROLE_PATH = '/aws-service-role/'
+# Outputs of the Differ that can be selected with --reports.
+REPORTS = ['summary', 'summary-json', 'roles', 'common-roles', 'unique-roles', 'common-differences']
+
+
+def print_summary_table(summary_json):
+    # Also used by the command line to show the summary of a diff run by "iamctl serve".
+    print(Style.BRIGHT)
+    print(Fore.YELLOW +"Summary report in tabular format:")
+    print(Style.RESET_ALL)
+
+    table = SingleTable([['Metric'] + summary_json['accounts']] + [[metric] + values for metric, values in summary_json['metrics'].items()])
+    table.title = "Summary Report"
+    table.inner_heading_row_border = True
+    table.inner_row_border = True
+    table.justify_columns[1] = 'right'
+    table.justify_columns[2] = 'right'
+    print(table.table)
+
 
 class Differ:
-    def __init__(self, extract_file_name_1, extract_file_name_2, account_1_tag, account_2_tag, output_directory):
+    # Name of the backend, sanitized items are cached per backend as their shape differs.
+    engine = 'python'
+
+    def __init__(self, extract_file_name_1, extract_file_name_2, account_1_tag, account_2_tag, output_directory, sink = None, cache = None):
 
         self.output_directory=output_directory
+        # Extract file names are resolved against the sink, reports are written to it.
+        self.sink = sink or LocalSink(output_directory)
         self.logger = logging.getLogger(__name__)
         self.extract_file_name_1 = extract_file_name_1
         self.extract_file_name_2 = extract_file_name_2
@@ -46,24 +74,22 @@ class Differ:
         self.equivalency_list_dict = None
         self.account_1_to_account_2_csv_out = None
         self.account_2_to_account_1_csv_out = None
+        self.cache = cache
         self.read_equivalency_dict()
-        self.read_extract_files()
 
     def read_equivalency_dict(self):
         with open('equivalency_list.json') as f:
             self.equivalency_list_dict = json.load(f)
 
-    def read_extract_files(self):
-        # Read the 2 extract files.
-        with open(self.extract_file_name_1) as f:
-            self.extract_file_handler_1 = f
+    def read_extract_file(self, extract_file_name):
+        with self.sink.open_read(extract_file_name) as f:
             next(csv.reader(f))
-            self.account_1_raw = [tuple(line) for line in csv.reader(f)]
+            return [tuple(line) for line in csv.reader(f)]
 
-        with open(self.extract_file_name_2) as f:
-            self.extract_file_handler_2 = f
-            next(csv.reader(f))
-            self.account_2_raw = [tuple(line) for line in csv.reader(f)]
+    def read_extract_files(self):
+        # Read the 2 extract files.
+        self.account_1_raw = self.read_extract_file(self.extract_file_name_1)
+        self.account_2_raw = self.read_extract_file(self.extract_file_name_2)
 
     # Get values after matching equivalency list
     def sanitize_value_with_equivalency(self, value):
@@ -86,195 +112,209 @@ class Differ:
         return output_list
 
     def write_to_csv(self,tuples, header, filename):
-        filehandler = open(self.output_directory+ "/" + filename, "wt", newline='')
-        csv_out = csv.writer(filehandler)
-        csv_out.writerow(header)
-        for each_tuple in tuples:
-            csv_out.writerow(each_tuple)
-        filename = filehandler.name
-        filehandler.close()
-        return filename
-
-    def generate_diff_and_summary(self):
-
-        summary = []
-        summary.append(['Metric', self.account_1_tag, self.account_2_tag])
-
-        sanitized_account_1_list = self.get_sanitized_list_with_equivalency(self.account_1_raw, self.account_1_tag)
-        sanitized_account_2_list = self.get_sanitized_list_with_equivalency(self.account_2_raw, self.account_2_tag)
-        
-        print(Style.BRIGHT)
-        print(Fore.BLUE + "Summary report in text format:")
-        print(Style.RESET_ALL)
+        with writing(self.sink, filename) as filehandler:
+            csv_out = csv.writer(filehandler)
+            csv_out.writerow(header)
+            # Sorted so that reports are reproducible, whichever backend or cache produced them.
+            for each_tuple in sorted(tuples):
+                csv_out.writerow(each_tuple)
+        return self.sink.location(filename)
 
-        print("Number of items in %s: %d" %(self.account_1_tag, len(self.account_1_raw)))
-        print("Number of items in %s: %d" %(self.account_2_tag, len(self.account_2_raw)))
-        
-        summary.append(['Harvested Items', len(self.account_1_raw), len(self.account_2_raw)])
-        
-        print("Number of items in %s after sanitizing: %d" % (self.account_1_tag, len(sanitized_account_1_list)))
-        print("Number of items in %s after sanitizing: %d" % (self.account_2_tag, len(sanitized_account_2_list)))
-
-        summary.append(['Sanitized Items', len(sanitized_account_1_list), len(sanitized_account_2_list)])
+    def compute_diff(self, sanitized_account_1_list, sanitized_account_2_list, item_differences = True):
+        results = {}
 
         account_1_roles = set([(item[0], item[1]) for item in sanitized_account_1_list])
-        print("Number of roles in %s: %d" %(self.account_1_tag, len(account_1_roles)))
-        headerrow =('rolename', 'path')
-        filename = self.account_1_tag + "_roles.csv"
-        self.write_to_csv(account_1_roles, headerrow, filename)
-
-        account_1_service_linked_roles = set([(item[0],) for item in sanitized_account_1_list if (item[1].startswith('/aws-service-role/'))])
-        print("Number of service linked roles in %s: %d" %(self.account_1_tag, len(account_1_service_linked_roles)))
-        headerrow =('rolename',)
-        filename = self.account_1_tag + "_service_linked_roles.csv"
-        self.write_to_csv(account_1_service_linked_roles, headerrow, filename)
-
-        account_1_non_service_linked_roles = set([(item[0],) for item in sanitized_account_1_list if not item[1].startswith('/aws-service-role/')])
-        print("Number of Non-service linked roles in %s: %d" %(self.account_1_tag, len(account_1_non_service_linked_roles)))
-        headerrow =('rolename',)
-        filename = self.account_1_tag + "_non_service_linked_roles.csv"
-        self.write_to_csv(account_1_non_service_linked_roles, headerrow, filename)
-
-        account_2_roles = set([(item[0],item[1]) for item in sanitized_account_2_list])
-        print("Number of roles in %s: %d" %(self.account_2_tag, len(account_2_roles)))
-        headerrow =('rolename', 'path')
-        filename = self.account_2_tag + "_roles.csv"
-        self.write_to_csv(account_2_roles, headerrow, filename)    
-
-        account_2_service_linked_roles = set([(item[0],) for item in sanitized_account_2_list if (item[1].startswith('/aws-service-role/'))])
-        print("Number of service linked roles in %s: %d" %(self.account_2_tag, len(account_2_service_linked_roles)))
-        headerrow =('rolename',)
-        filename = self.account_2_tag + "_service_linked_roles.csv"
-        self.write_to_csv(account_2_service_linked_roles, headerrow, filename)
-
-        account_2_non_service_linked_roles = set([(item[0],) for item in sanitized_account_2_list if not item[1].startswith('/aws-service-role/')])
-        print("Number of Non-service linked roles in %s: %d" %(self.account_2_tag, len(account_2_non_service_linked_roles)))
-        headerrow =('rolename',)
-        filename = self.account_2_tag + "_non_service_linked_roles.csv"
-        self.write_to_csv(account_2_non_service_linked_roles, headerrow, filename)
-
-        summary.append(['Roles',len(account_1_roles), len(account_2_roles)])
-        summary.append(['Service Linked Roles', len(account_1_service_linked_roles), len(account_2_service_linked_roles)])
-        summary.append(['Non-Service Linked Roles', len(account_1_non_service_linked_roles), len(account_2_non_service_linked_roles)])
-
-        # Getting list of common roles between 2 accounts using bitwise operator.
-        # If roles are common will return a 1.
-        common_role_list = set(account_1_roles) & set(account_2_roles)
-        print("Number of common roles: %d" %( len(common_role_list)))
-        headerrow =('rolename', 'path')
-        filename = "common_roles.csv"
-        self.write_to_csv(common_role_list, headerrow, filename)
-
-        common_service_linked_role_list = [(item[0],) for item in common_role_list if item[1].startswith('/aws-service-role/')]
-        print("Number of common roles that are service linked: %d" %(len(common_service_linked_role_list)))
-        headerrow =('rolename',)
-        filename = "common_service_linked_roles.csv"
-        self.write_to_csv(common_service_linked_role_list, headerrow, filename)
-
-        common_non_service_linked_role_list = [(item[0],) for item in common_role_list if not item[1].startswith('/aws-service-role/')]
-        print("Number of common roles that are Non-service linked: %d" %(len(common_non_service_linked_role_list)))
-        headerrow =('rolename',)
-        filename = "common_non_service_linked_roles.csv"
-        self.write_to_csv(common_non_service_linked_role_list, headerrow, filename)
-
-        summary.append(['Common Roles', len(common_role_list), len(common_role_list)])
-        summary.append(['Common Service Linked Roles', len(common_service_linked_role_list), len(common_service_linked_role_list)])
-        summary.append(['Common Non-Service Linked Roles', len(common_non_service_linked_role_list), len(common_non_service_linked_role_list)])
-
-        # Get roles that are in first but not in second.
-        account_1_diff_account_2 = set(account_1_roles) - set(account_2_roles) 
-
+        account_2_roles = set([(item[0], item[1]) for item in sanitized_account_2_list])
+        results['account_1_roles'] = account_1_roles
+        results['account_2_roles'] = account_2_roles
+
+        # Every role bucket is filled in a single pass over the roles of each account.
+        results['account_1_service_linked_roles'] = set()
+        results['account_1_non_service_linked_roles'] = set()
+        results['common_role_list'] = set()
+        results['common_service_linked_role_list'] = []
+        results['common_non_service_linked_role_list'] = []
+        results['account_1_diff_account_2_roles'] = set()
+        results['account_1_diff_account_2_service_linked_roles'] = []
+        results['account_1_diff_account_2_non_service_linked_roles'] = []
+        for role in account_1_roles:
+            service_linked = role[1].startswith(SERVICE_ROLE_PATH)
+            results['account_1_service_linked_roles' if service_linked else 'account_1_non_service_linked_roles'].add((role[0],))
+            if role in account_2_roles:
+                results['common_role_list'].add(role)
+                results['common_service_linked_role_list' if service_linked else 'common_non_service_linked_role_list'].append((role[0],))
+            else:
+                results['account_1_diff_account_2_roles'].add(role)
+                results['account_1_diff_account_2_service_linked_roles' if service_linked else 'account_1_diff_account_2_non_service_linked_roles'].append(role)
+
+        results['account_2_service_linked_roles'] = set()
+        results['account_2_non_service_linked_roles'] = set()
+        results['account_2_diff_account_1_roles'] = []
+        results['account_2_diff_account_1_service_linked_roles'] = []
+        results['account_2_diff_account_1_non_service_linked_roles'] = []
+        for role in account_2_roles:
+            service_linked = role[1].startswith(SERVICE_ROLE_PATH)
+            results['account_2_service_linked_roles' if service_linked else 'account_2_non_service_linked_roles'].add((role[0],))
+            if role not in account_1_roles:
+                results['account_2_diff_account_1_roles'].append(role)
+                results['account_2_diff_account_1_service_linked_roles' if service_linked else 'account_2_diff_account_1_non_service_linked_roles'].append(role)
+
+        if not item_differences:
+            return results
 
         #difference in items will not translate to roles, for e.g. you could have a role in account-a that has action item that is not in account-b
-        account_1_diff_account_2_roles =  set([(item[0],item[1]) for item in account_1_diff_account_2])
-        print("Number of roles from %s not in %s: %d" %(self.account_1_tag,self.account_2_tag, len(account_1_diff_account_2_roles)))
-        headerrow =('rolename', 'path')
-        filename = "roles_in_" + self.account_1_tag + "_but_not_in_" + self.account_2_tag + ".csv"
-        self.write_to_csv(account_1_diff_account_2_roles, headerrow, filename)
-
-        account_1_diff_account_2_service_linked_roles= [tup for tup in account_1_diff_account_2_roles if tup[1].startswith('/aws-service-role/')]
-        print("Number of service linked roles from %s not in %s: %d" %(self.account_1_tag,self.account_2_tag, len(account_1_diff_account_2_service_linked_roles)))
-        headerrow =('rolename', 'path')
-        filename = "service_linked_roles_in_" + self.account_1_tag + "_but_not_in_" + self.account_2_tag+" .csv"
-        self.write_to_csv(account_1_diff_account_2_service_linked_roles, headerrow, filename)
-
-        account_1_diff_account_2_non_service_linked_roles= [tup for tup in account_1_diff_account_2_roles if not tup[1].startswith('/aws-service-role/')]
-        print("Number of non-service linked roles from %s not in %s: %d" %(self.account_1_tag, self.account_2_tag, len(account_1_diff_account_2_non_service_linked_roles)))
-        headerrow =('rolename', 'path')
-        filename = "non_service_linked_roles_in_" + self.account_1_tag + "_but_not_in_" + self.account_2_tag + ".csv"
-        self.write_to_csv(account_1_diff_account_2_non_service_linked_roles, headerrow, filename)
-
-        # Get roles that are in second but not in first. 
-
-        account_2_diff_account_1 = set(account_2_roles) - set(account_1_roles) 
-        account_2_diff_account_1_roles =  list(set([(item[0],item[1]) for item in account_2_diff_account_1]))
-        print("Number of roles from %s not in %s: %d" %(self.account_2_tag,self.account_1_tag, len(account_2_diff_account_1_roles)))
-        headerrow =('rolename', 'path')
-        filename = "roles_in_" + self.account_2_tag + "_but_not_in_" + self.account_2_tag + ".csv"
-        self.write_to_csv(account_2_diff_account_1_roles, headerrow, filename)
-
-        account_2_diff_account_1_service_linked_roles= [tup for tup in account_2_diff_account_1_roles if tup[1].startswith('/aws-service-role/')]
-        print("Number of service linked roles from %s not in %s: %d" %(self.account_2_tag,self.account_1_tag, len(account_2_diff_account_1_service_linked_roles)))
-        headerrow =('rolename', 'path')
-        filename = "service_linked_roles_in_" + self.account_2_tag + "_but_not_in_" + self.account_1_tag + ".csv"
-        self.write_to_csv(account_2_diff_account_1_service_linked_roles, headerrow, filename)
-
-
-        account_2_diff_account_1_non_service_linked_roles= [tup for tup in account_2_diff_account_1_roles if not tup[1].startswith('/aws-service-role/')]
-        print("Number of non-service linked roles from %s not in %s: %d" %(self.account_2_tag, self.account_1_tag, len(account_2_diff_account_1_non_service_linked_roles)))
-        headerrow =('rolename', 'path')
-        filename = "non_service_linked_roles_in_" + self.account_2_tag + "_but_not_in_" + self.account_1_tag + ".csv"
-        self.write_to_csv(account_2_diff_account_1_non_service_linked_roles, headerrow, filename)
-
-        summary.append(['Unique Roles', len(account_1_diff_account_2_roles), len(account_2_diff_account_1_roles)])
-        summary.append(['Unique Service Linked Roles', len(account_1_diff_account_2_service_linked_roles), len(account_2_diff_account_1_service_linked_roles)])
-        summary.append(['Unique Non-Service Linked Roles', len(account_1_diff_account_2_non_service_linked_roles), len(account_2_diff_account_1_non_service_linked_roles)])
-
         account_1_diff_items_account_2 = set(sanitized_account_1_list).difference(set(sanitized_account_2_list))
         account_2_diff_items_account_1 = set(sanitized_account_2_list).difference(set(sanitized_account_1_list))
 
-
-        true_diff_account_1_with_common = [tup for tup in account_1_diff_items_account_2 if (tup[0] in [item[0] for item in common_role_list])]
-        print("There are %d items that are in different in %s among common roles between %s,%s" %(len(true_diff_account_1_with_common),self.account_1_tag, self.account_1_tag,self.account_2_tag))
-        headerrow =('rolename', 'path','trust', 'policyname', 'effect', 'service', 'action', 'arn')
-        filename = self.account_1_tag + "_to_" + self.account_2_tag + "_common_role_difference_items.csv"
-        self.write_to_csv(true_diff_account_1_with_common, headerrow, filename)
-
-        true_diff_role_account_1_with_common = set([(item[0],) for item in true_diff_account_1_with_common])
-        print("There are %d common roles in %s that have differences with %s "%(len(true_diff_role_account_1_with_common), self.account_1_tag, self.account_2_tag))
-        headerrow =('rolename',)
-        filename = "common_roles_in_" + self.account_1_tag + "_with_differences" + ".csv"
-        self.write_to_csv(true_diff_role_account_1_with_common, headerrow, filename)
-
-        # base_diff_account_2_with_common = [tup for tup in account_2 if (tup[0] in common_role_list)]
-        # print("Number of items in " + account2tag + " tied to common roles: " + str(len(base_diff_account_2_with_common)))
-        true_diff_account_2_with_common = [tup for tup in account_2_diff_items_account_1 if (tup[0] in [item[0] for item in common_role_list])]
-        print("There are %d items that are in different in %s among common roles between %s,%s" %(len(true_diff_account_2_with_common), self.account_2_tag, self.account_1_tag, self.account_2_tag))
-        headerrow =('rolename', 'path','trust', 'policyname', 'effect', 'service', 'action', 'arn')
-        filename = self.account_2_tag + "_to_" + self.account_1_tag + "_common_role_difference_items.csv"
-        self.write_to_csv(true_diff_account_2_with_common, headerrow, filename)
-        
-        true_diff_role_account_2_with_common = set([(item[0],) for item in true_diff_account_2_with_common])
-        print("There are %d common roles in %s that have differences with %s "%(len(true_diff_role_account_2_with_common), self.account_2_tag, self.account_1_tag))
-        headerrow = ('rolename',)
-        filename = "common_roles_in_" + self.account_2_tag + "_with_differences" + ".csv"
-        self.write_to_csv(true_diff_role_account_2_with_common, headerrow, filename)
-
-        summary.append(['Common Roles with Differences', len(true_diff_role_account_1_with_common), len(true_diff_role_account_2_with_common)])
-        summary.append(['Differences among Common Roles', len(true_diff_account_1_with_common), len(true_diff_account_2_with_common)])
-
-        print(Style.BRIGHT)
-        print(Fore.YELLOW +"Summary report in tabular format:")
-        print(Style.RESET_ALL)
-
-        table = SingleTable(summary)
-        table.title = "Summary Report"
-        table.inner_heading_row_border = True
-        table.inner_row_border = True
-        table.justify_columns[1] = 'right'
-        table.justify_columns[2] = 'right'
-        print(table.table)
-
-        print(Style.BRIGHT)
-        print(Fore.GREEN + "Detailed reports are available at this location:\n%s" %(self.output_directory))
-        print(Style.RESET_ALL)
+        common_role_names = set([item[0] for item in results['common_role_list']])
+        results['true_diff_account_1_with_common'] = [tup for tup in account_1_diff_items_account_2 if (tup[0] in common_role_names)]
+        results['true_diff_role_account_1_with_common'] = set([(item[0],) for item in results['true_diff_account_1_with_common']])
+        results['true_diff_account_2_with_common'] = [tup for tup in account_2_diff_items_account_1 if (tup[0] in common_role_names)]
+        results['true_diff_role_account_2_with_common'] = set([(item[0],) for item in results['true_diff_account_2_with_common']])
+        return results
+
+    def get_sanitized_account(self, extract_file_name, extract_hash, tag):
+        # Returns (number of harvested items, sanitized items) for one extract.
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(CACHE_VERSION, 'sanitized', self.engine, extract_hash, json.dumps(self.equivalency_list_dict))
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.logger.info("Using cached sanitized items for %s", tag)
+                return cached
+        raw = self.read_extract_file(extract_file_name)
+        sanitized = (len(raw), self.get_sanitized_list_with_equivalency(raw, tag))
+        if key is not None:
+            self.cache.put(key, sanitized)
+        return sanitized
+
+    def get_diff(self, item_differences = True):
+        extract_hash_1 = extract_hash_2 = None
+        key = None
+        if self.cache is not None:
+            with self.sink.open_read(self.extract_file_name_1) as f:
+                extract_hash_1 = self.cache.hash_file(f)
+            with self.sink.open_read(self.extract_file_name_2) as f:
+                extract_hash_2 = self.cache.hash_file(f)
+            key = self.cache.key(CACHE_VERSION, 'diff', extract_hash_1, extract_hash_2, json.dumps(self.equivalency_list_dict), self.account_1_tag, self.account_2_tag, str(item_differences))
+            results = self.cache.get(key)
+            if results is not None:
+                self.logger.info("Using cached diff for %s, %s", self.account_1_tag, self.account_2_tag)
+                return results
+
+        harvested_1, sanitized_account_1_list = self.get_sanitized_account(self.extract_file_name_1, extract_hash_1, self.account_1_tag)
+        harvested_2, sanitized_account_2_list = self.get_sanitized_account(self.extract_file_name_2, extract_hash_2, self.account_2_tag)
+
+        results = self.compute_diff(sanitized_account_1_list, sanitized_account_2_list, item_differences)
+        results['harvested_items'] = (harvested_1, harvested_2)
+        results['sanitized_items'] = (len(sanitized_account_1_list), len(sanitized_account_2_list))
+        if key is not None:
+            self.cache.put(key, results)
+        return results
+
+    def report_definitions(self):
+        # (report, results key, file name, header, console message) in the order they are printed.
+        tag_1, tag_2 = self.account_1_tag, self.account_2_tag
+        return [
+            ('roles', 'account_1_roles', tag_1 + "_roles.csv", ('rolename', 'path'),
+                lambda count: "Number of roles in %s: %d" %(tag_1, count)),
+            ('roles', 'account_1_service_linked_roles', tag_1 + "_service_linked_roles.csv", ('rolename',),
+                lambda count: "Number of service linked roles in %s: %d" %(tag_1, count)),
+            ('roles', 'account_1_non_service_linked_roles', tag_1 + "_non_service_linked_roles.csv", ('rolename',),
+                lambda count: "Number of Non-service linked roles in %s: %d" %(tag_1, count)),
+            ('roles', 'account_2_roles', tag_2 + "_roles.csv", ('rolename', 'path'),
+                lambda count: "Number of roles in %s: %d" %(tag_2, count)),
+            ('roles', 'account_2_service_linked_roles', tag_2 + "_service_linked_roles.csv", ('rolename',),
+                lambda count: "Number of service linked roles in %s: %d" %(tag_2, count)),
+            ('roles', 'account_2_non_service_linked_roles', tag_2 + "_non_service_linked_roles.csv", ('rolename',),
+                lambda count: "Number of Non-service linked roles in %s: %d" %(tag_2, count)),
+            ('common-roles', 'common_role_list', "common_roles.csv", ('rolename', 'path'),
+                lambda count: "Number of common roles: %d" %(count)),
+            ('common-roles', 'common_service_linked_role_list', "common_service_linked_roles.csv", ('rolename',),
+                lambda count: "Number of common roles that are service linked: %d" %(count)),
+            ('common-roles', 'common_non_service_linked_role_list', "common_non_service_linked_roles.csv", ('rolename',),
+                lambda count: "Number of common roles that are Non-service linked: %d" %(count)),
+            ('unique-roles', 'account_1_diff_account_2_roles', "roles_in_" + tag_1 + "_but_not_in_" + tag_2 + ".csv", ('rolename', 'path'),
+                lambda count: "Number of roles from %s not in %s: %d" %(tag_1, tag_2, count)),
+            ('unique-roles', 'account_1_diff_account_2_service_linked_roles', "service_linked_roles_in_" + tag_1 + "_but_not_in_" + tag_2 + " .csv", ('rolename', 'path'),
+                lambda count: "Number of service linked roles from %s not in %s: %d" %(tag_1, tag_2, count)),
+            ('unique-roles', 'account_1_diff_account_2_non_service_linked_roles', "non_service_linked_roles_in_" + tag_1 + "_but_not_in_" + tag_2 + ".csv", ('rolename', 'path'),
+                lambda count: "Number of non-service linked roles from %s not in %s: %d" %(tag_1, tag_2, count)),
+            ('unique-roles', 'account_2_diff_account_1_roles', "roles_in_" + tag_2 + "_but_not_in_" + tag_2 + ".csv", ('rolename', 'path'),
+                lambda count: "Number of roles from %s not in %s: %d" %(tag_2, tag_1, count)),
+            ('unique-roles', 'account_2_diff_account_1_service_linked_roles', "service_linked_roles_in_" + tag_2 + "_but_not_in_" + tag_1 + ".csv", ('rolename', 'path'),
+                lambda count: "Number of service linked roles from %s not in %s: %d" %(tag_2, tag_1, count)),
+            ('unique-roles', 'account_2_diff_account_1_non_service_linked_roles', "non_service_linked_roles_in_" + tag_2 + "_but_not_in_" + tag_1 + ".csv", ('rolename', 'path'),
+                lambda count: "Number of non-service linked roles from %s not in %s: %d" %(tag_2, tag_1, count)),
+            ('common-differences', 'true_diff_account_1_with_common', tag_1 + "_to_" + tag_2 + "_common_role_difference_items.csv", ('rolename', 'path','trust', 'policyname', 'effect', 'service', 'action', 'arn'),
+                lambda count: "There are %d items that are in different in %s among common roles between %s,%s" %(count, tag_1, tag_1, tag_2)),
+            ('common-differences', 'true_diff_role_account_1_with_common', "common_roles_in_" + tag_1 + "_with_differences" + ".csv", ('rolename',),
+                lambda count: "There are %d common roles in %s that have differences with %s " %(count, tag_1, tag_2)),
+            ('common-differences', 'true_diff_account_2_with_common', tag_2 + "_to_" + tag_1 + "_common_role_difference_items.csv", ('rolename', 'path','trust', 'policyname', 'effect', 'service', 'action', 'arn'),
+                lambda count: "There are %d items that are in different in %s among common roles between %s,%s" %(count, tag_2, tag_1, tag_2)),
+            ('common-differences', 'true_diff_role_account_2_with_common', "common_roles_in_" + tag_2 + "_with_differences" + ".csv", ('rolename',),
+                lambda count: "There are %d common roles in %s that have differences with %s " %(count, tag_2, tag_1)),
+        ]
+
+    def summary_rows(self, results):
+        def both(key_1, key_2):
+            return [len(results[key_1]), len(results[key_2])]
+        return [
+            ['Harvested Items'] + list(results['harvested_items']),
+            ['Sanitized Items'] + list(results['sanitized_items']),
+            ['Roles'] + both('account_1_roles', 'account_2_roles'),
+            ['Service Linked Roles'] + both('account_1_service_linked_roles', 'account_2_service_linked_roles'),
+            ['Non-Service Linked Roles'] + both('account_1_non_service_linked_roles', 'account_2_non_service_linked_roles'),
+            ['Common Roles'] + both('common_role_list', 'common_role_list'),
+            ['Common Service Linked Roles'] + both('common_service_linked_role_list', 'common_service_linked_role_list'),
+            ['Common Non-Service Linked Roles'] + both('common_non_service_linked_role_list', 'common_non_service_linked_role_list'),
+            ['Unique Roles'] + both('account_1_diff_account_2_roles', 'account_2_diff_account_1_roles'),
+            ['Unique Service Linked Roles'] + both('account_1_diff_account_2_service_linked_roles', 'account_2_diff_account_1_service_linked_roles'),
+            ['Unique Non-Service Linked Roles'] + both('account_1_diff_account_2_non_service_linked_roles', 'account_2_diff_account_1_non_service_linked_roles'),
+            ['Common Roles with Differences'] + both('true_diff_role_account_1_with_common', 'true_diff_role_account_2_with_common'),
+            ['Differences among Common Roles'] + both('true_diff_account_1_with_common', 'true_diff_account_2_with_common'),
+        ]
+
+    def generate_diff_and_summary(self, reports = None):
+        # reports: the subset of REPORTS to produce, all of them by default.
+        reports = set(reports or REPORTS)
+        # Item differences are the expensive part, only compute them when a chosen report needs them.
+        item_differences = bool(reports & set(['summary', 'summary-json', 'common-differences']))
+        results = self.get_diff(item_differences)
+        console = 'summary' in reports
+
+        if console:
+            print(Style.BRIGHT)
+            print(Fore.BLUE + "Summary report in text format:")
+            print(Style.RESET_ALL)
+
+            print("Number of items in %s: %d" %(self.account_1_tag, results['harvested_items'][0]))
+            print("Number of items in %s: %d" %(self.account_2_tag, results['harvested_items'][1]))
+            print("Number of items in %s after sanitizing: %d" % (self.account_1_tag, results['sanitized_items'][0]))
+            print("Number of items in %s after sanitizing: %d" % (self.account_2_tag, results['sanitized_items'][1]))
+
+        for report, key, filename, headerrow, message in self.report_definitions():
+            if key not in results:
+                continue
+            if console:
+                print(message(len(results[key])))
+            if report in reports:
+                self.write_to_csv(results[key], headerrow, filename)
+
+        summary_json = None
+        if item_differences:
+            summary = self.summary_rows(results)
+            summary_json = {'accounts': [self.account_1_tag, self.account_2_tag],
+                            'metrics': dict((row[0], row[1:]) for row in summary)}
+        if 'summary-json' in reports:
+            with writing(self.sink, 'summary.json') as f:
+                json.dump(summary_json, f, indent = 2)
+
+        if console:
+            print_summary_table(summary_json)
+
+        if reports != set(['summary']):
+            print(Style.BRIGHT)
+            print(Fore.GREEN + "Detailed reports are available at this location:\n%s" %(self.sink.location()))
+            print(Style.RESET_ALL)
+        return summary_json
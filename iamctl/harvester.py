@@ -16,6 +16,7 @@ import json
 from botocore.exceptions import ClientError
 import re
 import fnmatch
+import hashlib
 import logging
 import logging.config
 import csv
@@ -23,6 +24,8 @@ import sys
 import os
 import argparse
 import time
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from progress.bar import ChargingBar, Bar
 from pyfiglet import Figlet
@@ -30,27 +33,99 @@ from colorama import init,Fore, Back, Style
 from terminaltables import SingleTable
 from os.path import expanduser
 from os import path
+from iamctl.sink import LocalSink
 
-class Harvester:
+# Parsed managed policies kept by a HarvestContext, least recently used ones are dropped first.
+MAX_CACHED_POLICIES = 10000
+
+
+class PolicyCache:
+
+    def __init__(self, max_size = MAX_CACHED_POLICIES):
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.policies = OrderedDict()
+
+    def __len__(self):
+        return len(self.policies)
+
+    def get(self, key):
+        with self.lock:
+            policy = self.policies.get(key)
+            if policy is not None:
+                self.policies.move_to_end(key)
+            return policy
+
+    def put(self, key, policy):
+        with self.lock:
+            self.policies[key] = policy
+            self.policies.move_to_end(key)
+            while len(self.policies) > self.max_size:
+                self.policies.popitem(last = False)
 
-    def close_file_handler(self):
-        self.extract_file.close()
+
+class HarvestContext:
+    # Holds everything a Harvester can reuse between runs: the iam.json reference data
+    # (indexed by service prefix, ARN regexes precompiled), boto3 clients per profile and
+    # the parsed managed policies. A single context is shared by all jobs of "iamctl serve".
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.policy_cache = PolicyCache()
+        self.iam_reference_mtime = None
+        self.load_iam_reference()
 
     def read_iam_file(self):
         with open('iam.json') as json_file:  
             return json.load(json_file)
 
-    def return_service_iam_actions(self,service_prefix):
+    def load_iam_reference(self):
+        self.iam_reference = self.read_iam_file()
+        self.iam_reference_mtime = os.path.getmtime('iam.json')
+        self.service_actions = {}
+        self.service_arns = []
         for p in self.iam_reference['serviceMap']:
-            if (self.iam_reference['serviceMap'][p]['StringPrefix'] == service_prefix):
-                return self.iam_reference['serviceMap'][p]['Actions']
+            service = self.iam_reference['serviceMap'][p]
+            self.service_actions.setdefault(service['StringPrefix'], service['Actions'])
+            if ('ARNRegex' in service):
+                self.service_arns.append({'ARNRegex':service['ARNRegex'], 'StringPrefix':service['StringPrefix'], 'compiled':re.compile(service['ARNRegex'])})
+        # Parsed policies depend on the reference data, so they can't outlive it.
+        self.policy_cache = PolicyCache()
+
+    def refresh(self):
+        # Picks up a new iam.json written by "iamctl init" while the server is running.
+        with self.lock:
+            if os.path.getmtime('iam.json') != self.iam_reference_mtime:
+                self.logger.info("iam.json changed, reloading reference data")
+                self.load_iam_reference()
+
+    def snapshot(self):
+        # Reference tables and policy cache of one iam.json version, taken together so that
+        # a harvest never mixes two versions when refresh() runs for another job.
+        with self.lock:
+            return self.iam_reference, self.service_actions, self.service_arns, self.policy_cache
+
+    def get_client(self, cli_profile_name, endpoint_url = None):
+        # boto3 sessions are not thread safe but the clients created from them are,
+        # so each profile gets one session and one client that all jobs share.
+        with self.lock:
+            if (cli_profile_name, endpoint_url) not in self.clients:
+                self.clients[(cli_profile_name, endpoint_url)] = boto3.Session(profile_name=cli_profile_name).client('iam', endpoint_url = endpoint_url)
+            return self.clients[(cli_profile_name, endpoint_url)]
+
+
+class Harvester:
+
+    def close_file_handler(self):
+        self.extract_file.close()
+
+    def return_service_iam_actions(self,service_prefix):
+        return self.service_actions.get(service_prefix)
 
     def return_service_arns(self):
-        arns=[]
-        for p in self.iam_reference['serviceMap']:
-            if ('ARNRegex' in self.iam_reference['serviceMap'][p]):
-                arns.append({'ARNRegex':self.iam_reference['serviceMap'][p]['ARNRegex'], 'StringPrefix':self.iam_reference['serviceMap'][p]['StringPrefix']})
-        return arns
+        return self.service_arns
 
     def match_action_regex(self, match_action, service_prefix):
         matches = []
@@ -65,22 +140,48 @@ class Harvester:
         matches = []
         arns = self.return_service_arns()
         for arn in arns or []:
-            arn_regex = re.compile(arn['ARNRegex'])
-            if arn_regex.match(match_resource):
+            if arn['compiled'].match(match_resource):
                 matches.append(arn)
         return matches
 
 
     def get_iam_roles(self):
         paginator = self.client.get_paginator('list_roles')
+        # PathPrefix is filtered by IAM itself, everything else in select_roles.
+        path_prefix = {'PathPrefix': self.path_prefix} if self.path_prefix else {}
         response_iterator = paginator.paginate( 
             PaginationConfig = {
                 'PageSize': 1000,
-                'StartingToken': None})
+                'StartingToken': None},
+            **path_prefix)
         
         roles = response_iterator.build_full_result()
         self.logger.info("Number of roles: %d",len(roles['Roles']))
-        return roles['Roles']
+        return self.select_roles(roles['Roles'])
+
+    def role_shard(self, role_name):
+        # md5 rather than hash() so that every worker computes the same partition.
+        return int(hashlib.md5(role_name.encode('utf-8')).hexdigest(), 16) % self.shard[1]
+
+    def role_in_scope(self, role):
+        if self.skip_service_linked and role['Path'].startswith('/aws-service-role/'):
+            return False
+        if self.include and not any(fnmatch.fnmatchcase(role['RoleName'], pattern) for pattern in self.include):
+            return False
+        if self.exclude and any(fnmatch.fnmatchcase(role['RoleName'], pattern) for pattern in self.exclude):
+            return False
+        return True
+
+    def select_roles(self, roles):
+        # Runs before any per-role API call, so roles out of scope cost nothing.
+        selected = [role for role in roles if self.role_in_scope(role)]
+        if len(selected) != len(roles):
+            self.logger.info("Number of roles in scope: %d", len(selected))
+        if self.shard is None:
+            return selected
+        selected = [role for role in selected if self.role_shard(role['RoleName']) == self.shard[0]]
+        self.logger.info("Number of roles in shard %d/%d: %d", self.shard[0], self.shard[1], len(selected))
+        return selected
 
 
     def get_role_inline_policies(self, role_name):
@@ -248,13 +349,20 @@ class Harvester:
         for attached_policy in attached_policies:
             policyresponse = self.get_policy(attached_policy['PolicyArn'])['Policy']
             self.logger.debug(str(policyresponse))
-            policyversion = self.get_policy_version(attached_policy['PolicyArn'], policyresponse['DefaultVersionId'])['PolicyVersion']
-            policy_document = policyversion['Document']
-            
             self.logger.info("Attached Policy Name: " + attached_policy['PolicyName'])
-            
-            self.logger.debug(str(policy_document))
-            parsed_policy = self.parse_policy(policy_document)
+
+            # Managed policies are typically attached to many roles, a given version never changes.
+            # The ARN is not enough: a policy deleted and created again under the same name gets it
+            # back with a new PolicyId, and restarts at v1. The same ARN can also exist on another
+            # endpoint, e.g. a fake IAM endpoint used for testing.
+            cache_key = (self.cli_profile_name, self.endpoint_url, policyresponse['PolicyId'], policyresponse['DefaultVersionId'])
+            parsed_policy = self.policy_cache.get(cache_key)
+            if parsed_policy is None:
+                policyversion = self.get_policy_version(attached_policy['PolicyArn'], policyresponse['DefaultVersionId'])['PolicyVersion']
+                policy_document = policyversion['Document']
+                self.logger.debug(str(policy_document))
+                parsed_policy = self.parse_policy(policy_document)
+                self.policy_cache.put(cache_key, parsed_policy)
             parsed_attached_policies.append({'name': attached_policy['PolicyName'], 'type' : 'managed', 'statements' : parsed_policy})
         return parsed_attached_policies
 
@@ -310,30 +418,55 @@ class Harvester:
         parsed_policies.extend(processed_attached_policies)
         return parsed_policies
 
+    def open_extract_file(self):
+        self.extract_file = self.sink.open(self.extract_name)
+        self.csv_out = csv.writer(self.extract_file)
+        self.csv_out.writerow(('rolename', 'path', 'policyname', 'policytype', 'effect', 'service', 'action', 'arn', 'principal'))
+
     def harvest_iam_roles_from_account(self):
-        roles=self.get_iam_roles()
-        self.logger.info("Number of roles: %d", len(roles))
-        #bar = ProgressBar('Something')
-        bar = ChargingBar('Harvesting IAM Roles from '+self.account_tag, max=len(roles),suffix='%(index)d/%(max)d - %(eta)ds')
-        for role in roles:
-            parsed_policies = self.process_role(role)        
-            self.write_out_exhaust({'name': role['RoleName'],'path':role['Path'],'policies':parsed_policies})
-            bar.next()
+        self.open_extract_file()
+        try:
+            roles=self.get_iam_roles()
+            self.logger.info("Number of roles: %d", len(roles))
+            #bar = ProgressBar('Something')
+            bar = ChargingBar('Harvesting IAM Roles from '+self.account_tag, max=len(roles),suffix='%(index)d/%(max)d - %(eta)ds')
+            for role in roles:
+                parsed_policies = self.process_role(role)        
+                self.write_out_exhaust({'name': role['RoleName'],'path':role['Path'],'policies':parsed_policies})
+                bar.next()
+        except BaseException:
+            # Only a complete harvest may be published, a partial extract would look like deleted roles.
+            self.sink.abort(self.extract_file, self.extract_name)
+            raise
         self.close_file_handler()
         bar.finish()
 
-    def __init__(self, cli_profile_name, account_tag, output_directory):
+    def __init__(self, cli_profile_name, account_tag, output_directory, context = None, shard = None, endpoint_url = None, sink = None, path_prefix = None, include = None, exclude = None, skip_service_linked = False, client = None):
         # create self.logger, TBD change this to get logging conf based on class name
         self.logger = logging.getLogger(__name__)
-        self.iam_reference = self.read_iam_file()
+        self.context = context or HarvestContext()
+        self.iam_reference, self.service_actions, self.service_arns, self.policy_cache = self.context.snapshot()
         self.cli_profile_name = cli_profile_name
         self.account_tag = account_tag
         self.output_directory = output_directory
+        self.sink = sink or LocalSink(output_directory)
+        # (index, count): only harvest the roles whose name hashes to this shard.
+        self.shard = shard
+        # Harvest scope: list_roles PathPrefix, role name globs to include/exclude, service linked roles.
+        self.path_prefix = path_prefix
+        self.include = include
+        self.exclude = exclude
+        self.skip_service_linked = skip_service_linked
+        self.endpoint_url = endpoint_url
         # Any clients created from this session will use credentials
         # from the [dev] section of ~/.aws/credentials.
-        self.client = boto3.Session(profile_name=cli_profile_name).client('iam')
-
-        self.filename = self.output_directory + '/' + account_tag + '_' + cli_profile_name + '_iam_tuples.csv'
-        self.extract_file = open(self.filename, "w", newline = '')
-        self.csv_out = csv.writer(self.extract_file)
-        self.csv_out.writerow(('rolename', 'path', 'policyname', 'policytype', 'effect', 'service', 'action', 'arn', 'principal'))
\ No newline at end of file
+        # A client can also be passed in, e.g. the recording or replaying clients of iamctl.recorder.
+        self.client = client if client is not None else self.context.get_client(cli_profile_name, endpoint_url)
+
+        self.extract_name = account_tag + '_' + cli_profile_name + '_iam_tuples.csv'
+        if self.shard is not None:
+            self.extract_name = account_tag + '_' + cli_profile_name + '_iam_tuples.shard-%d-of-%d.csv' % self.shard
+        self.filename = self.sink.location(self.extract_name)
+        # Opened when the harvest starts, so a Harvester that never runs writes nothing.
+        self.extract_file = None
+        self.csv_out = None
\ No newline at end of file
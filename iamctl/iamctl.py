@@ -22,6 +22,7 @@ import sys
 import os
 import argparse
 import time
+import tempfile
 from datetime import datetime
 from progress.bar import ChargingBar, Bar
 from pyfiglet import Figlet
@@ -29,41 +30,118 @@ from colorama import init,Fore, Back, Style
 from terminaltables import SingleTable
 from os.path import expanduser
 from os import path
-from iamctl.harvester import Harvester
-from iamctl.differ import Differ
+from iamctl.harvester import Harvester, HarvestContext
+from iamctl.differ import Differ, REPORTS, print_summary_table
+from iamctl.cache import DiffCache
+from iamctl.merger import Merger
+from iamctl.recorder import RecordingClient, ReplayClient
+from iamctl.server import Server, forward_job
+from iamctl.sink import make_sink
+from iamctl.trust_graph import TrustGraph
 from pkg_resources import get_distribution, DistributionNotFound
 
 
 
-def fix_me_a_directory(output):
+def fix_me_a_directory(output, unique=False):
     if output is None:
         output_directory = expanduser("~") + '/aws-idt/output' + time.strftime("/%Y/%m/%d/%H/%M/%S")
+        if unique:
+            # Jobs of "iamctl serve" run concurrently and would write over each other's files.
+            parent, name = os.path.split(output_directory)
+            os.makedirs(parent, exist_ok=True)
+            return tempfile.mkdtemp(prefix=name + '-', dir=parent)
         if not os.path.exists(output_directory):
             os.makedirs(output_directory)
         return output_directory
+    elif output.startswith('s3://'):
+        return output.rstrip('/')
     else:
         return output
 
 def check_if_init():
     return os.path.isfile('iam.json') and os.path.isfile('equivalency_list.json')
 
-def harvest(profile_name,account_name,output):
+def parse_shard(value):
+    # "i/N" -> (i, N) with 0 <= i < N
+    match = re.match(r'^(\d+)/(\d+)$', value)
+    if match is None or int(match.group(1)) >= int(match.group(2)):
+        raise argparse.ArgumentTypeError('expected i/N with 0 <= i < N, got "%s"' % value)
+    return (int(match.group(1)), int(match.group(2)))
+
+def parse_latency(value):
+    try:
+        latency = float(value)
+    except ValueError:
+        latency = -1
+    if not latency >= 0:
+        raise argparse.ArgumentTypeError('expected a latency in milliseconds >= 0, got "%s"' % value)
+    return latency
+
+def parse_throttle_rate(value):
+    # A rate of 1 would throttle every retry too, so every call would fail.
+    try:
+        rate = float(value)
+    except ValueError:
+        rate = -1
+    if not 0 <= rate < 1:
+        raise argparse.ArgumentTypeError('expected a rate with 0 <= rate < 1, got "%s"' % value)
+    return rate
+
+def parse_reports(value):
+    reports = [report.strip() for report in value.split(',') if report.strip()]
+    unknown = [report for report in reports if report not in REPORTS]
+    if unknown or not reports:
+        raise argparse.ArgumentTypeError('unknown report(s) "%s", choose from %s' % (','.join(unknown), ','.join(REPORTS)))
+    return reports
+
+def harvest(profile_name,account_name,output, shard=None, endpoint_url=None, gzip=False, s3_endpoint_url=None, path_prefix=None, include=None, exclude=None, skip_service_linked=False,
+            record=None, scrub_account_ids=False, replay=None, replay_latency=0, replay_throttle_rate=0, context=None):
     if not check_if_init():
         print(Fore.YELLOW + 'Please initialize using "iamctl init"')
+    elif replay and not path.isdir(replay):
+        print(Fore.YELLOW + 'No recording found in %s, record one with "iamctl harvest --record"' % replay)
+        print(Style.RESET_ALL)
     else:
-        output_directory = fix_me_a_directory(output)
-        harvest = Harvester(profile_name, account_name, output_directory)
+        output_directory = fix_me_a_directory(output, unique=context is not None)
+        sink = make_sink(output_directory, gzip, s3_endpoint_url)
+        client = None
+        if record or replay:
+            # Never share the warm policy cache of a server: it would skip get_policy_version
+            # calls, leaving them out of a recording or changing what a replay does, and
+            # recorded policies would end up in the cache used by live harvests.
+            context = HarvestContext()
+        context = context or HarvestContext()
+        if replay:
+            # No AWS credentials are needed, every IAM response comes from the recording.
+            client = ReplayClient(replay, replay_latency / 1000.0, replay_throttle_rate)
+        elif record:
+            client = RecordingClient(context.get_client(profile_name, endpoint_url), record, scrub_account_ids)
+        harvest = Harvester(profile_name, account_name, output_directory, context, shard=tuple(shard) if shard else None, endpoint_url=endpoint_url, sink=sink,
+                            path_prefix=path_prefix, include=include, exclude=exclude, skip_service_linked=skip_service_linked, client=client)
         #This will harvest all the iam roles from account-1 and write it to an extract file under output/ directory
         harvest.harvest_iam_roles_from_account()
+        if replay:
+            print(Fore.GREEN + 'Replayed %d IAM calls from %s, %d simulated throttles' % (client.calls, replay, client.throttled))
+            print(Style.RESET_ALL)
+        return {'output': output_directory, 'files': [harvest.filename]}
 
 
-def diff(profile_name_1, account_name_1, profile_name_2, account_name_2, output):
+def diff(profile_name_1, account_name_1, profile_name_2, account_name_2, output, endpoint_url=None, gzip=False, s3_endpoint_url=None, no_cache=False, cache_dir=None, cache_size=1024, engine='python', reports=None, path_prefix=None, include=None, exclude=None, skip_service_linked=False, context=None):
+    differ_class = Differ
+    if engine == 'pandas':
+        # Imported here, pandas and numpy take longer to import than the rest of iamctl.
+        from iamctl.frame_differ import FrameDiffer
+        differ_class = FrameDiffer
     if not check_if_init():
         print(Fore.YELLOW + 'Please initialize using "iamctl init"')
+    elif engine == 'pandas' and not differ_class.available():
+        print(Fore.YELLOW + 'The pandas engine needs pandas and numpy, install them with "pip install iamctl[pandas]"')
     else:
-        output_directory = fix_me_a_directory(output)
-        harvest1 = Harvester(profile_name_1, account_name_1, output_directory)
-        harvest2 = Harvester(profile_name_2, account_name_2, output_directory)
+        output_directory = fix_me_a_directory(output, unique=context is not None)
+        sink = make_sink(output_directory, gzip, s3_endpoint_url)
+        scope = {'path_prefix': path_prefix, 'include': include, 'exclude': exclude, 'skip_service_linked': skip_service_linked}
+        harvest1 = Harvester(profile_name_1, account_name_1, output_directory, context, endpoint_url=endpoint_url, sink=sink, **scope)
+        harvest2 = Harvester(profile_name_2, account_name_2, output_directory, context, endpoint_url=endpoint_url, sink=sink, **scope)
 
         #This will harvest all the iam roles from account-1 and write it to an extract file under output/ directory
         harvest1.harvest_iam_roles_from_account()
@@ -72,10 +150,120 @@ def diff(profile_name_1, account_name_1, profile_name_2, account_name_2, output)
         harvest2.harvest_iam_roles_from_account()
 
         #instantiating Differ object with extract file name from each of the harvest objects for both accounts.
-        differ = Differ(harvest1.filename, harvest2.filename, account_name_1, account_name_2, output_directory)
+        cache = None if no_cache else DiffCache(cache_dir, cache_size * 1024 * 1024)
+        differ = differ_class(harvest1.extract_name, harvest2.extract_name, account_name_1, account_name_2, output_directory, sink, cache)
 
         #This will generate the diff files comparing both accounts for IAM roles and prints the summary report to console
-        differ.generate_diff_and_summary() 
+        summary = differ.generate_diff_and_summary(reports)
+        return {'output': output_directory, 'files': [harvest1.filename, harvest2.filename], 'summary': summary}
+
+def merge(profile_name, account_name, extract_files, output, gzip=False, s3_endpoint_url=None):
+    output_directory = fix_me_a_directory(output)
+    merger = Merger(extract_files, profile_name, account_name, output_directory, make_sink(output_directory, gzip, s3_endpoint_url), s3_endpoint_url)
+    try:
+        filename = merger.merge()
+    except ValueError as e:
+        print(Fore.RED + 'Could not merge shard extracts: %s' % e)
+        print(Style.RESET_ALL)
+        sys.exit(1)
+    print(Fore.GREEN + u'\N{check mark} Merged %d shard extracts into %s' % (len(extract_files), filename))
+    print(Style.RESET_ALL)
+
+def parse_extract(value):
+    # "<extract>[=<account id>]", the account id lets role ARNs in policies be matched exactly
+    location, _, account_id = value.rpartition('=')
+    if location and re.match(r'^\d{12}$', account_id):
+        return (location, account_id)
+    return (value, None)
+
+def trust_graph(extract_files, role, principal, index, save, precompute, s3_endpoint_url):
+    if index:
+        graph = TrustGraph.load(index)
+    elif extract_files:
+        graph = TrustGraph().build([parse_extract(extract_file) for extract_file in extract_files], s3_endpoint_url)
+    else:
+        print(Fore.YELLOW + 'Please give the extract files to build the trust graph from, or an --index saved earlier')
+        print(Style.RESET_ALL)
+        sys.exit(1)
+    if precompute:
+        graph.precompute()
+    if save:
+        graph.save(save)
+        print(Fore.GREEN + u'\N{check mark} Saved trust graph with %d nodes and %d edges to %s' % (len(graph.nodes), len(graph.targets), save))
+        print(Style.RESET_ALL)
+
+    for name, reverse, title in [(name, True, 'can reach') for name in role or []] + [(name, False, 'is reachable from') for name in principal or []]:
+        nodes = graph.find(name)
+        if not nodes:
+            print(Fore.YELLOW + 'No role or principal named %s in the trust graph' % name)
+            print(Style.RESET_ALL)
+        for node in nodes:
+            reachable = sorted(graph.nodes[other] for other in graph.reachable(node, reverse))
+            if reverse:
+                print(Fore.BLUE + 'Principals that can reach %s: %d' % (graph.nodes[node], len(reachable)))
+            else:
+                print(Fore.BLUE + 'Roles reachable from %s: %d' % (graph.nodes[node], len(reachable)))
+            print(Style.RESET_ALL + '\n'.join(reachable))
+
+def serve(socket, host, port, workers):
+    server = Server({'harvest': harvest, 'diff': diff}, socket_path=socket, host=host, port=port, workers=workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(Fore.BLUE + 'Shutting down iamctl server')
+        print(Style.RESET_ALL)
+    except RuntimeError as e:
+        print(Fore.RED + 'iamctl server could not start: %s' % e)
+        print(Style.RESET_ALL)
+        sys.exit(1)
+
+def forward_to_server(command, kwargs):
+    # Hands harvest/diff over to a running "iamctl serve" so that it runs with warm caches.
+    if not check_if_init():
+        print(Fore.YELLOW + 'Please initialize using "iamctl init"')
+        print(Style.RESET_ALL)
+        return
+    if kwargs.get('output') is not None and not kwargs['output'].startswith('s3://'):
+        kwargs['output'] = os.path.abspath(kwargs['output'])
+    for directory in ('record', 'replay', 'cache_dir'):
+        if kwargs.get(directory) is not None:
+            kwargs[directory] = os.path.abspath(kwargs[directory])
+    try:
+        job = forward_job(command, kwargs)
+    except RuntimeError as e:
+        print(Fore.RED + 'iamctl server could not run the job: %s' % e)
+        print(Style.RESET_ALL)
+        sys.exit(1)
+    if job is None:
+        print(Fore.RED + 'No iamctl server is reachable, start one with "iamctl serve" or run the command with --local')
+        print(Style.RESET_ALL)
+        sys.exit(1)
+    if job['status'] != 'done':
+        print(Fore.RED + 'iamctl server job %s failed:\n%s' % (job['id'], job.get('error')))
+        print(Style.RESET_ALL)
+        sys.exit(1)
+    result = job['result'] or {}
+    if result.get('summary') and 'summary' in (kwargs.get('reports') or REPORTS):
+        print_summary_table(result['summary'])
+    print(Fore.GREEN + 'Job %s completed by the iamctl server.' % job['id'])
+    if result.get('output'):
+        print('Files are available at this location:\n%s' % result['output'])
+    print(Style.RESET_ALL)
+
+def add_scope_arguments(subparser):
+    subparser.add_argument('--path-prefix', dest='path_prefix', help='Only harvest roles under this path, e.g. /app/ (passed to IAM ListRoles as PathPrefix)')
+    subparser.add_argument('--include', dest='include', action='append', help='Only harvest roles whose name matches this glob, e.g. "app-*". Can be repeated')
+    subparser.add_argument('--exclude', dest='exclude', action='append', help='Skip roles whose name matches this glob. Can be repeated')
+    subparser.add_argument('--skip-service-linked', dest='skip_service_linked', action='store_true', help='Skip service linked roles (path /aws-service-role/)')
+
+def add_server_arguments(subparser):
+    subparser.add_argument('--server', action='store_true', help='Run the job on the iamctl server at IAMCTL_SERVER or ~/.iamctl/iamctl.sock, which must run in the same directory and AWS environment')
+    subparser.add_argument('--local', action='store_true', help='Run in this process even if IAMCTL_SERVER is set')
+
+def print_banner():
+    f = Figlet(font='bulbhead')
+    print(Fore.BLUE + f.renderText('IAMctl'))
+    print(Style.RESET_ALL)
 
 def init():
     print(Fore.BLUE + 'Initializing')
@@ -121,9 +309,6 @@ def main():
     # create self.logger, TBD change this to get logging conf based on class name
     logger = logging.getLogger(__name__)
 
-    f = Figlet(font='bulbhead')
-    print(Fore.BLUE + f.renderText('IAMctl'))
-    print(Style.RESET_ALL)
     parser = argparse.ArgumentParser(description='IAMCTL is a tool built to make it easy to export, compare and analyze AWS IAM Roles, policies across accounts. Helpful for Auditing, Archiving. See below for more use-case specific commands and their requirements. Uses AWS Boto3 SDK and AWS CLI profiles')
     parser.add_argument('--version', '-V', '-v', action='version', version="%(prog)s " + __version__)
     subparsers = parser.add_subparsers(dest='subparser')
@@ -136,21 +321,80 @@ def main():
     harvest_parser = subparsers.add_parser('harvest', help='Downloads the IAM Roles, policies expands glob patterns, matches resources to service actions and writes the output as csv to default <user_home>/aws-idt directory with a time based folder structure')
     harvest_parser.add_argument('profile_name', help='AWS CLI Profile Name for Account-1')
     harvest_parser.add_argument('account_name', help='Account-1 Tag [Without any Spaces]')
-    harvest_parser.add_argument('--output',dest ='output', help='Output directory location where files will be written to')
+    harvest_parser.add_argument('--output',dest ='output', help='Output directory location where files will be written to, or s3://bucket/prefix to stream the files to S3')
+    harvest_parser.add_argument('--gzip', dest='gzip', action='store_true', help='gzip compress the files written')
+    harvest_parser.add_argument('--s3-endpoint-url', dest='s3_endpoint_url', help='S3 endpoint to use with an s3:// output, e.g. a MinIO server')
+    harvest_parser.add_argument('--shard', dest='shard', type=parse_shard, help='Only harvest shard i of N (i/N, 0 based), roles are partitioned by a hash of the role name. Combine the shard extracts with "iamctl merge"')
+    harvest_parser.add_argument('--endpoint-url', dest='endpoint_url', help='IAM endpoint to use instead of the AWS default, e.g. a local fake IAM endpoint')
+    add_scope_arguments(harvest_parser)
+    recording = harvest_parser.add_mutually_exclusive_group()
+    recording.add_argument('--record', dest='record', metavar='DIRECTORY', help='Save every IAM response received during the harvest to this directory, to be replayed with --replay')
+    recording.add_argument('--replay', dest='replay', metavar='DIRECTORY', help='Harvest offline from IAM responses saved with --record instead of calling AWS')
+    harvest_parser.add_argument('--scrub-account-ids', dest='scrub_account_ids', action='store_true', help='With --record, replace the 12 digit account ids in the saved responses with fake ones')
+    harvest_parser.add_argument('--replay-latency', dest='replay_latency', type=parse_latency, default=0, metavar='MS', help='With --replay, simulated latency of every IAM call in milliseconds')
+    harvest_parser.add_argument('--replay-throttle-rate', dest='replay_throttle_rate', type=parse_throttle_rate, default=0, metavar='RATE', help='With --replay, fraction of IAM calls (0 <= rate < 1) that are throttled and retried with backoff')
+    add_server_arguments(harvest_parser)
 
     diff_parser = subparsers.add_parser('diff', help='Compares the two accounts supplied as input for differences in IAM roles, policies by first harvesting from both accounts and then applying the equivalency list string patterns to ignore known false positive triggers. Write several summary level and granular observations to files to the default <user_home>/aws-idt directory with a time based folder structure ')
     diff_parser.add_argument('profile_name_1', help='AWS CLI Profile Name for Account-1')
     diff_parser.add_argument('account_name_1', help='Account-1 Tag [Without any Spaces]')
     diff_parser.add_argument('profile_name_2', help='AWS CLI Profile Name for Account-2')
     diff_parser.add_argument('account_name_2', help='Account-2 Tag [Without any Spaces]')
-    diff_parser.add_argument('--output',dest ='output', help='Output directory location where files will be written to')
+    diff_parser.add_argument('--output',dest ='output', help='Output directory location where files will be written to, or s3://bucket/prefix to stream the files to S3')
+    diff_parser.add_argument('--gzip', dest='gzip', action='store_true', help='gzip compress the files written')
+    diff_parser.add_argument('--s3-endpoint-url', dest='s3_endpoint_url', help='S3 endpoint to use with an s3:// output, e.g. a MinIO server')
+    diff_parser.add_argument('--endpoint-url', dest='endpoint_url', help='IAM endpoint to use instead of the AWS default, e.g. a local fake IAM endpoint')
+    diff_parser.add_argument('--reports', dest='reports', type=parse_reports, help='Comma separated list of outputs to produce, out of: %s. Only what these outputs need is computed. Defaults to all of them' % ', '.join(REPORTS))
+    diff_parser.add_argument('--engine', dest='engine', choices=['python', 'pandas'], default='python', help='Diff backend, pandas works on categorical columns and is faster on large extracts (needs pandas installed)')
+    diff_parser.add_argument('--no-cache', dest='no_cache', action='store_true', help='Do not read or write the cache of sanitized items and diff results')
+    diff_parser.add_argument('--cache-dir', dest='cache_dir', help='Cache directory, defaults to <user_home>/.iamctl/cache')
+    diff_parser.add_argument('--cache-size', dest='cache_size', type=int, default=1024, help='Maximum cache size in MiB, least recently used entries are evicted first')
+    add_scope_arguments(diff_parser)
+    add_server_arguments(diff_parser)
+
+    merge_parser = subparsers.add_parser('merge', help='Combines the extracts written by "harvest --shard i/N" for all N shards of an account into <account_tag>_<cli_profile>_iam_tuples.csv: the same rows as a single harvest, roles in name order')
+    merge_parser.add_argument('profile_name', help='AWS CLI Profile Name the shards were harvested with')
+    merge_parser.add_argument('account_name', help='Account Tag the shards were harvested with [Without any Spaces]')
+    merge_parser.add_argument('extract_files', nargs='+', help='Shard extract files or s3:// URLs (*_iam_tuples.shard-<i>-of-<N>.csv[.gz])')
+    merge_parser.add_argument('--output',dest ='output', help='Output directory location where files will be written to, or s3://bucket/prefix to stream the files to S3')
+    merge_parser.add_argument('--gzip', dest='gzip', action='store_true', help='gzip compress the files written')
+    merge_parser.add_argument('--s3-endpoint-url', dest='s3_endpoint_url', help='S3 endpoint to use with s3:// files, e.g. a MinIO server')
+
+    trust_graph_parser = subparsers.add_parser('trust-graph', help='Builds a graph of which principals can assume which roles, directly or through chains of roles, from harvested extracts and answers reachability queries. Only Allow statements are used, so results over-approximate (Deny, conditions and NotAction are not evaluated)')
+    trust_graph_parser.add_argument('extract_files', nargs='*', help='Extract files or s3:// URLs, optionally as <extract>=<account id> so that role ARNs are matched with their account')
+    trust_graph_parser.add_argument('--role', dest='role', action='append', help='List the principals that can reach this role, by role name or ARN. Can be repeated')
+    trust_graph_parser.add_argument('--principal', dest='principal', action='append', help='List the roles reachable from this principal or role. Can be repeated')
+    trust_graph_parser.add_argument('--save', dest='save', help='Save the trust graph to this file for later queries with --index')
+    trust_graph_parser.add_argument('--index', dest='index', help='Load a trust graph saved with --save instead of reading extracts')
+    trust_graph_parser.add_argument('--precompute', dest='precompute', action='store_true', help='Precompute reachability for every node, worthwhile for large fleets together with --save')
+    trust_graph_parser.add_argument('--s3-endpoint-url', dest='s3_endpoint_url', help='S3 endpoint to use with s3:// files, e.g. a MinIO server')
+
+    serve_parser = subparsers.add_parser('serve', help='Runs iamctl as a long lived server that keeps iam.json, boto3 clients and parsed policies warm and accepts harvest and diff jobs over a local Unix socket (default ~/.iamctl/iamctl.sock) or HTTP. harvest and diff run on the server when given --server or when IAMCTL_SERVER is set to its address')
+    serve_parser.add_argument('--socket', dest='socket', help='Unix socket path to listen on')
+    serve_parser.add_argument('--host', dest='host', default='127.0.0.1', help='Host to listen on when --port is given. HTTP clients must send the token from ~/.iamctl/token (or IAMCTL_TOKEN), which travels unencrypted: only listen on trusted networks')
+    serve_parser.add_argument('--port', dest='port', type=int, help='Listen on HTTP at this port instead of a Unix socket')
+    serve_parser.add_argument('--workers', dest='workers', type=int, default=4, help='Maximum number of jobs running at the same time')
 
     if len(sys.argv)==1:
+        print_banner()
         parser.print_help(sys.stderr)
         sys.exit(1)
     else:
         kwargs = vars(parser.parse_args())
-        globals()[kwargs.pop('subparser')](**kwargs)
+        command = kwargs.pop('subparser')
+        if command == 'harvest':
+            if kwargs['scrub_account_ids'] and not kwargs['record']:
+                harvest_parser.error('--scrub-account-ids requires --record')
+            if (kwargs['replay_latency'] or kwargs['replay_throttle_rate']) and not kwargs['replay']:
+                harvest_parser.error('--replay-latency and --replay-throttle-rate require --replay')
+        if command in ('harvest', 'diff'):
+            # Forwarding is opt-in: a job runs with the server's iam.json, equivalency list and credentials.
+            use_server = kwargs.pop('server') or os.environ.get('IAMCTL_SERVER')
+            if not kwargs.pop('local') and use_server:
+                forward_to_server(command, kwargs)
+                return
+        print_banner()
+        globals()[command.replace('-', '_')](**kwargs)
 
 
 
@@ -0,0 +1,84 @@
+#   Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+
+#       http://www.apache.org/licenses/LICENSE-2.0
+
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+import csv
+import logging
+import re
+from os import path
+from iamctl.sink import LocalSink, open_location, writing
+
+SHARD_SUFFIX = re.compile(r'\.shard-(\d+)-of-(\d+)\.csv(\.gz)?$')
+
+
+class Merger:
+    # Combines the extracts written by "harvest --shard i/N" into
+    # <account_tag>_<cli_profile>_iam_tuples.csv, with the rows a single harvest
+    # would have written. Roles are written in name order, rows of a role keep
+    # their harvested order.
+
+    def __init__(self, extract_file_names, cli_profile_name, account_tag, output_directory, sink = None, s3_endpoint_url = None):
+        self.logger = logging.getLogger(__name__)
+        self.extract_file_names = extract_file_names
+        self.cli_profile_name = cli_profile_name
+        self.account_tag = account_tag
+        self.output_directory = output_directory
+        self.sink = sink or LocalSink(output_directory)
+        self.s3_endpoint_url = s3_endpoint_url
+        self.extract_name = account_tag + '_' + cli_profile_name + '_iam_tuples.csv'
+        self.filename = self.sink.location(self.extract_name)
+
+    def check_shards(self):
+        # Refuse to write a partial extract, a missing shard would silently look like deleted roles.
+        shards = {}
+        counts = set()
+        prefix = self.account_tag + '_' + self.cli_profile_name + '_iam_tuples'
+        for extract_file_name in self.extract_file_names:
+            match = SHARD_SUFFIX.search(path.basename(extract_file_name))
+            if match is None:
+                raise ValueError("Not a shard extract: %s" % extract_file_name)
+            # Shards of another account or profile would silently end up in this extract.
+            if path.basename(extract_file_name)[:match.start()] != prefix:
+                raise ValueError("Not a shard of %s with profile %s: %s" % (self.account_tag, self.cli_profile_name, extract_file_name))
+            index, count = int(match.group(1)), int(match.group(2))
+            if index in shards:
+                raise ValueError("Shard %d is given twice: %s, %s" % (index, shards[index], extract_file_name))
+            shards[index] = extract_file_name
+            counts.add(count)
+        if len(counts) != 1:
+            raise ValueError("Shards come from harvests with different shard counts: %s" % sorted(counts))
+        missing = sorted(set(range(counts.pop())) - set(shards))
+        if missing:
+            raise ValueError("Missing shards: %s" % ', '.join(str(index) for index in missing))
+
+    def merge(self):
+        self.check_shards()
+        header = None
+        roles = {}
+        for extract_file_name in self.extract_file_names:
+            with open_location(extract_file_name, self.s3_endpoint_url) as f:
+                reader = csv.reader(f)
+                shard_header = next(reader)
+                if header is None:
+                    header = shard_header
+                elif shard_header != header:
+                    raise ValueError("Unexpected header in %s" % extract_file_name)
+                for row in reader:
+                    roles.setdefault(row[0], []).append(row)
+        self.logger.info("Number of roles merged: %d", len(roles))
+
+        with writing(self.sink, self.extract_name) as f:
+            csv_out = csv.writer(f)
+            csv_out.writerow(header)
+            for role_name in sorted(roles):
+                csv_out.writerows(roles[role_name])
+        return self.filename
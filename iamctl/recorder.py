@@ -0,0 +1,197 @@
+#   Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+
+#       http://www.apache.org/licenses/LICENSE-2.0
+
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from botocore.exceptions import ClientError
+
+ACCOUNT_ID = re.compile(r'(?<!\d)\d{12}(?!\d)')
+# Like botocore's legacy retry mode: up to 4 retries with exponential backoff.
+MAX_THROTTLE_RETRIES = 4
+THROTTLE_BASE_DELAY = 0.05
+
+
+def request_key(operation, params):
+    # PaginationConfig only changes how a result is fetched, not the result.
+    params = dict((k, v) for k, v in params.items() if k != 'PaginationConfig')
+    return hashlib.sha1(json.dumps([operation, params], sort_keys = True).encode('utf-8')).hexdigest()
+
+
+class RecordingClient:
+    # Wraps a boto3 IAM client and saves every response the Harvester receives to
+    # <directory>/<operation>/<request hash>.json, for ReplayClient to serve later.
+    # With scrub_account_ids every 12 digit account id in requests and responses is
+    # replaced by 100000000001, 100000000002, ... in the order they are first seen.
+
+    def __init__(self, client, directory, scrub_account_ids = False):
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.directory = directory
+        self.scrub_account_ids = scrub_account_ids
+        self.account_ids = {}
+        self.real_account_ids = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok = True)
+
+    def scrub_account_id(self, match):
+        with self.lock:
+            if match.group(0) not in self.account_ids:
+                fake_account_id = str(100000000001 + len(self.account_ids))
+                self.account_ids[match.group(0)] = fake_account_id
+                self.real_account_ids[fake_account_id] = match.group(0)
+            return self.account_ids[match.group(0)]
+
+    def unscrub_account_id(self, match):
+        return self.real_account_ids.get(match.group(0), match.group(0))
+
+    def replace_account_ids(self, value, replace):
+        if isinstance(value, str):
+            return ACCOUNT_ID.sub(replace, value)
+        if isinstance(value, dict):
+            return dict((self.replace_account_ids(k, replace), self.replace_account_ids(v, replace)) for k, v in value.items())
+        if isinstance(value, list):
+            return [self.replace_account_ids(v, replace) for v in value]
+        return value
+
+    def scrub(self, value):
+        return self.replace_account_ids(value, self.scrub_account_id) if self.scrub_account_ids else value
+
+    def unscrub(self, value):
+        return self.replace_account_ids(value, self.unscrub_account_id) if self.scrub_account_ids else value
+
+    def record(self, operation, params, response):
+        # params are what the Harvester asked for, already scrubbed as it only sees scrubbed responses.
+        response = dict((k, v) for k, v in response.items() if k != 'ResponseMetadata')
+        operation_directory = os.path.join(self.directory, operation)
+        os.makedirs(operation_directory, exist_ok = True)
+        with open(os.path.join(operation_directory, request_key(operation, params) + '.json'), 'w') as f:
+            # Dates become ISO strings, the Harvester does not use them.
+            json.dump({'operation': operation, 'params': params, 'response': self.scrub(response)}, f, indent = 1, default = str)
+        # Scrubbed responses are returned too so that follow up requests use the ids the replay will see.
+        return self.scrub(response)
+
+    def get_paginator(self, operation):
+        return RecordingPaginator(self, operation, self.client.get_paginator(operation))
+
+    def __getattr__(self, operation):
+        method = getattr(self.client, operation)
+
+        def call(**params):
+            return self.record(operation, params, method(**self.unscrub(params)))
+        return call
+
+
+class RecordingPaginator:
+
+    def __init__(self, recorder, operation, paginator):
+        self.recorder = recorder
+        self.operation = operation
+        self.paginator = paginator
+
+    def paginate(self, **params):
+        return RecordingPageIterator(self.recorder, self.operation, params, self.paginator.paginate(**self.recorder.unscrub(params)))
+
+
+class RecordingPageIterator:
+
+    def __init__(self, recorder, operation, params, page_iterator):
+        self.recorder = recorder
+        self.operation = operation
+        self.params = params
+        self.page_iterator = page_iterator
+
+    def build_full_result(self):
+        return self.recorder.record(self.operation, self.params, self.page_iterator.build_full_result())
+
+
+class ReplayClient:
+    # Serves responses saved by RecordingClient in place of a boto3 IAM client.
+    # latency (seconds) is added to every call. throttle_rate is the chance that a
+    # call is throttled, throttled calls are retried after an exponential backoff like
+    # botocore does and fail with a Throttling error after MAX_THROTTLE_RETRIES.
+    # Throttling decisions come from a seeded generator so runs are reproducible.
+
+    def __init__(self, directory, latency = 0, throttle_rate = 0, seed = 0):
+        self.logger = logging.getLogger(__name__)
+        self.directory = directory
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.throttled = 0
+        if not os.path.isdir(directory):
+            raise ValueError("No recording found in %s" % directory)
+
+    def throttle(self, operation):
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            with self.lock:
+                throttled = self.random.random() < self.throttle_rate
+                if throttled:
+                    self.throttled += 1
+            if not throttled:
+                return
+            if attempt == MAX_THROTTLE_RETRIES:
+                raise ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded (simulated)'}}, operation)
+            time.sleep(THROTTLE_BASE_DELAY * (2 ** attempt))
+
+    def replay(self, operation, params):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.throttle_rate:
+            self.throttle(operation)
+        try:
+            with open(os.path.join(self.directory, operation, request_key(operation, params) + '.json')) as f:
+                return json.load(f)['response']
+        except FileNotFoundError:
+            raise ClientError({'Error': {'Code': 'NoSuchEntity', 'Message': 'No recorded response for %s %s' % (operation, json.dumps(params, sort_keys = True, default = str))}}, operation)
+
+    def get_paginator(self, operation):
+        return ReplayPaginator(self, operation)
+
+    def __getattr__(self, operation):
+        if operation.startswith('__'):
+            raise AttributeError(operation)
+
+        def call(**params):
+            return self.replay(operation, params)
+        return call
+
+
+class ReplayPaginator:
+
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, **params):
+        return ReplayPageIterator(self.client, self.operation, params)
+
+
+class ReplayPageIterator:
+
+    def __init__(self, client, operation, params):
+        self.client = client
+        self.operation = operation
+        self.params = params
+
+    def build_full_result(self):
+        return self.client.replay(self.operation, self.params)
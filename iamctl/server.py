@@ -0,0 +1,328 @@
+#   Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+
+#       http://www.apache.org/licenses/LICENSE-2.0
+
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import socket
+import socketserver
+import threading
+import time
+import traceback
+import uuid
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import expanduser
+from iamctl.harvester import HarvestContext
+
+DEFAULT_SOCKET = expanduser("~") + '/.iamctl/iamctl.sock'
+# Shared secret that HTTP clients must send, the Unix socket is protected by its permissions.
+TOKEN_FILE = expanduser("~") + '/.iamctl/token'
+# Finished jobs submitted with "wait": false stay available on GET /jobs/<id> for
+# FINISHED_JOB_TTL seconds, and at most MAX_FINISHED_JOBS of them are kept.
+FINISHED_JOB_TTL = 3600
+MAX_FINISHED_JOBS = 100
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout = None):
+        super().__init__('localhost', timeout = timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    # GET  /ping        -> server status
+    # POST /jobs        -> {"command": "harvest"|"diff", "args": {...}, "environment": {...}, "wait": true}
+    # GET  /jobs/<id>   -> status and result of a job
+
+    def address_string(self):
+        # Unix socket peers have no address.
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        self.server.iamctl.logger.info("%s - %s", self.address_string(), format % args)
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def authorized(self):
+        token = self.server.iamctl.token
+        if token is None:
+            return True
+        if hmac.compare_digest(self.headers.get('Authorization', ''), 'Bearer ' + token):
+            return True
+        self.send_json(401, {'error': 'Missing or wrong token, see ' + TOKEN_FILE})
+        return False
+
+    def do_GET(self):
+        iamctl_server = self.server.iamctl
+        if not self.authorized():
+            return
+        if self.path == '/ping':
+            self.send_json(200, iamctl_server.status())
+        elif self.path.startswith('/jobs/'):
+            job = iamctl_server.jobs.get(self.path[len('/jobs/'):])
+            if job is None:
+                self.send_json(404, {'error': 'Unknown job'})
+            else:
+                self.send_json(200, iamctl_server.describe(job))
+        else:
+            self.send_json(404, {'error': 'Unknown path ' + self.path})
+
+    def do_POST(self):
+        iamctl_server = self.server.iamctl
+        if not self.authorized():
+            return
+        if self.path != '/jobs':
+            self.send_json(404, {'error': 'Unknown path ' + self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            job = iamctl_server.submit(request['command'], request.get('args', {}), request.get('environment'))
+        except (ValueError, KeyError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        if not request.get('wait', True):
+            self.send_json(200, iamctl_server.describe(job))
+            return
+        job['future'].exception()
+        try:
+            self.send_json(200, iamctl_server.describe(job))
+        finally:
+            # The caller got the result in this response, nobody will ask for it again.
+            iamctl_server.forget(job)
+
+
+class Server:
+
+    def __init__(self, runners, socket_path = None, host = None, port = None, workers = 4):
+        self.logger = logging.getLogger(__name__)
+        self.runners = runners
+        self.socket_path = socket_path
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.environment = job_environment()
+        # Everything that is expensive to build per invocation lives in the context and is kept warm here.
+        self.context = HarvestContext()
+        self.executor = ThreadPoolExecutor(max_workers = workers)
+        self.httpd = None
+        self.token = None
+
+    def finish(self, job):
+        with self.jobs_lock:
+            job['finished'] = time.time()
+
+    def forget(self, job):
+        with self.jobs_lock:
+            self.jobs.pop(job['id'], None)
+
+    def prune(self):
+        # Called with jobs_lock held.
+        now = time.time()
+        finished = sorted((job['finished'], job_id) for job_id, job in self.jobs.items() if 'finished' in job)
+        for position, (finished_time, job_id) in enumerate(finished):
+            if now - finished_time > FINISHED_JOB_TTL or len(finished) - position > MAX_FINISHED_JOBS:
+                del self.jobs[job_id]
+
+    def status(self):
+        with self.jobs_lock:
+            self.prune()
+            states = [job['future'] for job in self.jobs.values()]
+        return {'status': 'ok',
+                'pid': os.getpid(),
+                'workers': self.workers,
+                'running': len([f for f in states if f.running()]),
+                'queued': len([f for f in states if not f.running() and not f.done()]),
+                'cached_clients': len(self.context.clients),
+                'cached_policies': len(self.context.policy_cache)}
+
+    def describe(self, job):
+        future = job['future']
+        description = {'id': job['id'], 'command': job['command'], 'args': job['args']}
+        if not future.done():
+            description['status'] = 'running' if future.running() else 'queued'
+        elif future.exception() is not None:
+            description['status'] = 'failed'
+            description['error'] = job.get('error', str(future.exception()))
+        else:
+            description['status'] = 'done'
+            description['result'] = future.result()
+        return description
+
+    def run(self, job):
+        self.logger.info("Starting job %s: %s", job['id'], job['command'])
+        try:
+            self.context.refresh()
+            return self.runners[job['command']](context = self.context, **job['args'])
+        except Exception:
+            job['error'] = traceback.format_exc()
+            self.logger.error(job['error'])
+            raise
+
+    def check_environment(self, environment):
+        # The same job must not give different results depending on where it was started from.
+        if environment['cwd'] != self.environment['cwd']:
+            raise ValueError("The iamctl server runs in %s, which has its own iam.json and equivalency_list.json. "
+                             "Run the command from that directory or use --local" % self.environment['cwd'])
+        if environment['aws_environment'] != self.environment['aws_environment']:
+            raise ValueError("The AWS_* environment variables of the iamctl server differ from yours. "
+                             "Restart the server with your environment or use --local")
+
+    def submit(self, command, args, environment = None):
+        if command not in self.runners:
+            raise ValueError("Unsupported command: %s" % command)
+        if environment is not None:
+            self.check_environment(environment)
+        job = {'id': uuid.uuid4().hex, 'command': command, 'args': args}
+        with self.jobs_lock:
+            self.prune()
+            self.jobs[job['id']] = job
+            job['future'] = self.executor.submit(self.run, job)
+        job['future'].add_done_callback(lambda future: self.finish(job))
+        return job
+
+    def serve_forever(self):
+        if self.port is not None:
+            # Jobs run with the AWS profiles of the server owner, only clients holding the token may submit them.
+            self.token = read_token(create = True)
+            self.httpd = ThreadingHTTPServer((self.host or '127.0.0.1', self.port), JobRequestHandler)
+            address = 'http://%s:%d' % self.httpd.server_address[:2]
+        else:
+            socket_path = self.socket_path or DEFAULT_SOCKET
+            os.makedirs(os.path.dirname(socket_path), exist_ok = True)
+            if os.path.exists(socket_path):
+                if server_reachable('unix:' + socket_path):
+                    raise RuntimeError("An iamctl server is already listening on " + socket_path)
+                os.unlink(socket_path)
+            self.httpd = UnixHTTPServer(socket_path, JobRequestHandler)
+            os.chmod(socket_path, 0o600)
+            address = 'unix:' + socket_path
+        self.httpd.iamctl = self
+        print("iamctl server listening on %s with %d workers" % (address, self.workers))
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.httpd.server_close()
+            self.executor.shutdown(wait = False)
+            if self.port is None:
+                os.unlink(self.socket_path or DEFAULT_SOCKET)
+        return address
+
+
+def read_token(create = False):
+    # IAMCTL_TOKEN, or the token file which the server creates on first use.
+    if os.environ.get('IAMCTL_TOKEN'):
+        return os.environ['IAMCTL_TOKEN']
+    try:
+        if os.stat(TOKEN_FILE).st_mode & 0o077:
+            raise RuntimeError("%s must only be accessible by its owner, run chmod 600 %s" % (TOKEN_FILE, TOKEN_FILE))
+        with open(TOKEN_FILE) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        if not create:
+            return None
+    os.makedirs(os.path.dirname(TOKEN_FILE), exist_ok = True)
+    token = secrets.token_hex(32)
+    with os.fdopen(os.open(TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+        f.write(token)
+    return token
+
+
+def job_environment():
+    # What a job depends on besides its arguments: iam.json and equivalency_list.json are
+    # read from the working directory, credentials and region come from AWS_* variables.
+    aws_environment = sorted((k, v) for k, v in os.environ.items() if k.startswith('AWS_'))
+    return {'cwd': os.getcwd(),
+            'aws_environment': hashlib.sha256(json.dumps(aws_environment).encode('utf-8')).hexdigest()}
+
+
+def server_address():
+    # IAMCTL_SERVER takes either "unix:/path/to/socket" or "http://host:port".
+    address = os.environ.get('IAMCTL_SERVER')
+    if address:
+        return address
+    if os.path.exists(DEFAULT_SOCKET):
+        return 'unix:' + DEFAULT_SOCKET
+    return None
+
+
+def connect(address, timeout = None):
+    if address.startswith('unix:'):
+        return UnixHTTPConnection(address[len('unix:'):], timeout = timeout)
+    hostport = address.split('://', 1)[-1].rstrip('/')
+    return http.client.HTTPConnection(hostport, timeout = timeout)
+
+
+def request(address, method, path, body = None, timeout = None):
+    connection = connect(address, timeout = timeout)
+    try:
+        payload = None if body is None else json.dumps(body).encode('utf-8')
+        headers = {} if payload is None else {'Content-Type': 'application/json'}
+        if not address.startswith('unix:'):
+            token = read_token()
+            if token:
+                headers['Authorization'] = 'Bearer ' + token
+        connection.request(method, path, body = payload, headers = headers)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read().decode('utf-8'))
+    finally:
+        connection.close()
+
+
+def server_reachable(address):
+    try:
+        status, _ = request(address, 'GET', '/ping', timeout = 2)
+        return status == 200
+    except (OSError, ValueError, http.client.HTTPException):
+        return False
+
+
+def forward_job(command, args):
+    # Returns the finished job description, or None when no server is running.
+    address = server_address()
+    if address is None:
+        return None
+    try:
+        status, body = request(address, 'GET', '/ping', timeout = 2)
+    except (OSError, ValueError, http.client.HTTPException):
+        return None
+    if status != 200:
+        raise RuntimeError(body.get('error', 'iamctl server returned HTTP %d' % status))
+    status, job = request(address, 'POST', '/jobs', {'command': command, 'args': args, 'environment': job_environment(), 'wait': True})
+    if status != 200:
+        raise RuntimeError(job.get('error', 'iamctl server returned HTTP %d' % status))
+    return job
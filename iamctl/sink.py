@@ -0,0 +1,189 @@
+#   Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+
+#       http://www.apache.org/licenses/LICENSE-2.0
+
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+import boto3
+import gzip
+import io
+import logging
+import os
+import zlib
+from contextlib import contextmanager
+
+# S3 requires every part but the last one to be at least 5 MiB.
+PART_SIZE = 8 * 1024 * 1024
+
+
+class MultipartUploadWriter(io.RawIOBase):
+    # Streams bytes to an S3 object, uploading a part every PART_SIZE bytes.
+    # Objects that never fill a part are written with a single put_object.
+
+    def __init__(self, client, bucket, key, compress = False, part_size = PART_SIZE):
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.aborted = False
+        # wbits=31 makes zlib write a gzip header and trailer.
+        self.compressor = zlib.compressobj(wbits = 31) if compress else None
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.aborted:
+            return len(b)
+        data = bytes(b)
+        self.buffer.extend(self.compressor.compress(data) if self.compressor else data)
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def upload_part(self, body):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket = self.bucket, Key = self.key)['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket = self.bucket, Key = self.key, UploadId = self.upload_id, PartNumber = part_number, Body = body)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.logger.debug("Uploaded part %d of s3://%s/%s", part_number, self.bucket, self.key)
+
+    def abort(self):
+        # Drops everything written so far, close() then leaves no object behind.
+        self.aborted = True
+
+    def close(self):
+        if self.closed:
+            return
+        if self.aborted:
+            try:
+                if self.upload_id is not None:
+                    self.client.abort_multipart_upload(Bucket = self.bucket, Key = self.key, UploadId = self.upload_id)
+            finally:
+                self.buffer = bytearray()
+                super().close()
+            return
+        try:
+            if self.compressor:
+                self.buffer.extend(self.compressor.flush())
+            if self.upload_id is None:
+                self.client.put_object(Bucket = self.bucket, Key = self.key, Body = bytes(self.buffer))
+            else:
+                if self.buffer:
+                    self.upload_part(bytes(self.buffer))
+                self.client.complete_multipart_upload(Bucket = self.bucket, Key = self.key, UploadId = self.upload_id, MultipartUpload = {'Parts': self.parts})
+        except Exception:
+            if self.upload_id is not None:
+                self.client.abort_multipart_upload(Bucket = self.bucket, Key = self.key, UploadId = self.upload_id)
+            raise
+        finally:
+            self.buffer = bytearray()
+            super().close()
+
+
+class LocalSink:
+    # Writes extracts and reports to a local directory.
+
+    def __init__(self, directory, compress = False):
+        self.directory = directory
+        self.compress = compress
+
+    def location(self, name = None):
+        if name is None:
+            return self.directory
+        return os.path.join(self.directory, name + ('.gz' if self.compress else ''))
+
+    def open(self, name):
+        if self.compress:
+            return gzip.open(self.location(name), "wt", newline = '')
+        return open(self.location(name), "w", newline = '')
+
+    def abort(self, f, name):
+        # A truncated file would look like a complete extract or report, remove it.
+        f.close()
+        if os.path.exists(self.location(name)):
+            os.remove(self.location(name))
+
+    def open_read(self, name):
+        return open_location(self.location(name))
+
+
+class S3Sink:
+    # Streams extracts and reports to s3://bucket/prefix as they are written,
+    # nothing is staged on local disk.
+
+    def __init__(self, url, compress = False, endpoint_url = None):
+        bucket, _, prefix = url[len('s3://'):].partition('/')
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.compress = compress
+        self.client = boto3.Session().client('s3', endpoint_url = endpoint_url)
+
+    def key(self, name):
+        name = name + ('.gz' if self.compress else '')
+        return self.prefix + '/' + name if self.prefix else name
+
+    def location(self, name = None):
+        if name is None:
+            return 's3://%s/%s' % (self.bucket, self.prefix)
+        return 's3://%s/%s' % (self.bucket, self.key(name))
+
+    def open(self, name):
+        writer = MultipartUploadWriter(self.client, self.bucket, self.key(name), self.compress)
+        return io.TextIOWrapper(io.BufferedWriter(writer), encoding = 'utf-8', newline = '')
+
+    def abort(self, f, name):
+        # Nothing is published: the multipart upload is aborted instead of completed.
+        f.buffer.raw.abort()
+        f.close()
+
+    def open_read(self, name):
+        body = self.client.get_object(Bucket = self.bucket, Key = self.key(name))['Body']
+        if self.compress:
+            body = gzip.GzipFile(fileobj = body)
+        return io.TextIOWrapper(body, encoding = 'utf-8', newline = '')
+
+
+def make_sink(output, compress = False, s3_endpoint_url = None):
+    if output.startswith('s3://'):
+        return S3Sink(output, compress, s3_endpoint_url)
+    return LocalSink(output, compress)
+
+
+@contextmanager
+def writing(sink, name):
+    # Like "with sink.open(name)", but the file is only published when the block completes.
+    f = sink.open(name)
+    try:
+        yield f
+    except BaseException:
+        sink.abort(f, name)
+        raise
+    f.close()
+
+
+def open_location(location, s3_endpoint_url = None):
+    # Opens a local path or s3:// URL written by a sink for reading, .gz files are decompressed.
+    compressed = location.endswith('.gz')
+    if location.startswith('s3://'):
+        bucket, _, key = location[len('s3://'):].partition('/')
+        body = boto3.Session().client('s3', endpoint_url = s3_endpoint_url).get_object(Bucket = bucket, Key = key)['Body']
+        if compressed:
+            body = gzip.GzipFile(fileobj = body)
+        return io.TextIOWrapper(body, encoding = 'utf-8', newline = '')
+    if compressed:
+        return gzip.open(location, "rt", newline = '')
+    return open(location, newline = '')
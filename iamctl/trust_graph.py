@@ -0,0 +1,281 @@
+#   Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+#   Licensed under the Apache License, Version 2.0 (the "License").
+#   You may not use this file except in compliance with the License.
+#   A copy of the License is located at
+
+#       http://www.apache.org/licenses/LICENSE-2.0
+
+#   or in the "license" file accompanying this file. This file is distributed
+#   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+#   express or implied. See the License for the specific language governing
+#   permissions and limitations under the License.
+
+import csv
+import fnmatch
+import logging
+import pickle
+import re
+from array import array
+from collections import deque
+from iamctl.sink import open_location
+
+ROLE_ARN = re.compile(r'^arn:aws[\w-]*:iam::([^:]*):role/(.+)$')
+ROOT_ARN = re.compile(r'^arn:aws[\w-]*:iam::(\d+):root$')
+ASSUME_ROLE_ACTIONS = ('AssumeRole', '*')
+
+
+class TrustGraph:
+    # Directed graph of who can assume which role, built from harvested extracts.
+    # Nodes are roles (named by their ARN, with * as account when the account id of
+    # the extract is unknown) and every other trusted principal. There is an edge
+    # A -> B when B's trust policy allows A, or when B trusts the root of A's account
+    # and A is allowed sts:AssumeRole on B. Edges are kept as CSR adjacency arrays in
+    # both directions, reachability is answered with BFS and cached, or precomputed on
+    # the DAG of strongly connected components: every component keeps the sorted
+    # array of the components it reaches, so memory follows the size of the answers.
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.nodes = []
+        self.node_index = {}
+        self.roles = set()
+        self.offsets = array('i', [0])
+        self.targets = array('i')
+        self.reverse_offsets = array('i', [0])
+        self.reverse_targets = array('i')
+        self.component = None
+        self.component_offsets = None
+        self.component_members = None
+        self.closure = None
+        self.reverse_closure = None
+        self.cache = {}
+
+    def add_node(self, name):
+        if name not in self.node_index:
+            self.node_index[name] = len(self.nodes)
+            self.nodes.append(name)
+        return self.node_index[name]
+
+    def role_arn(self, account_id, path, rolename):
+        return 'arn:aws:iam::%s:role%s%s' % (account_id or '*', path, rolename)
+
+    def read_extracts(self, extracts, s3_endpoint_url = None):
+        # extracts: list of (location, account id or None)
+        trusts = []
+        permissions = []
+        for location, account_id in extracts:
+            with open_location(location, s3_endpoint_url) as f:
+                reader = csv.reader(f)
+                next(reader)
+                for rolename, path, policyname, policytype, effect, service, action, arn, principal in reader:
+                    role = self.role_arn(account_id, path, rolename)
+                    self.roles.add(self.add_node(role))
+                    # Deny is not evaluated and NotAction rows look like Action rows in an
+                    # extract, so the graph over-approximates who can assume a role.
+                    if effect != 'Allow':
+                        continue
+                    if policytype == 'trust':
+                        trusts.append((principal, role))
+                    elif service in ('sts', '*') and action in ASSUME_ROLE_ACTIONS:
+                        permissions.append((role, account_id, arn))
+        return trusts, permissions
+
+    def resolve_roles(self, pattern):
+        # Role nodes matching a role ARN from a policy, which may contain wildcards
+        # or point to a role whose extract has no account id.
+        if pattern == '*':
+            return list(self.roles)
+        match = ROLE_ARN.match(pattern)
+        if match is None:
+            return []
+        unknown_account = self.role_arn(None, '/', '') + match.group(2)
+        if '*' in pattern or '?' in pattern:
+            return [node for node in self.roles if fnmatch.fnmatchcase(self.nodes[node], pattern) or fnmatch.fnmatchcase(self.nodes[node], unknown_account)]
+        return [self.node_index[name] for name in (pattern, unknown_account) if name in self.node_index]
+
+    def build(self, extracts, s3_endpoint_url = None):
+        trusts, permissions = self.read_extracts(extracts, s3_endpoint_url)
+        edges = set()
+        roots = {}
+        for principal, role in trusts:
+            target = self.node_index[role]
+            sources = self.resolve_roles(principal) if principal.startswith('arn:') else []
+            if not sources:
+                sources = [self.add_node(principal)]
+                root = ROOT_ARN.match(principal)
+                if root:
+                    roots.setdefault(root.group(1), []).append(target)
+            for source in sources:
+                edges.add((source, target))
+        # Trusting an account root delegates to the identity policies of that account.
+        for role, account_id, arn in permissions:
+            trusting = set(roots.get(account_id, []))
+            for target in self.resolve_roles(arn):
+                if target in trusting:
+                    edges.add((self.node_index[role], target))
+        self.set_edges(edges)
+        self.logger.info("Trust graph with %d nodes, %d roles and %d edges", len(self.nodes), len(self.roles), len(edges))
+        return self
+
+    def set_edges(self, edges):
+        self.offsets, self.targets = self.to_csr([(source, target) for source, target in edges])
+        self.reverse_offsets, self.reverse_targets = self.to_csr([(target, source) for source, target in edges])
+        self.component = None
+        self.component_offsets = None
+        self.component_members = None
+        self.closure = None
+        self.reverse_closure = None
+        self.cache = {}
+
+    def to_csr(self, edges):
+        counts = [0] * (len(self.nodes) + 1)
+        for source, _ in edges:
+            counts[source + 1] += 1
+        for node in range(len(self.nodes)):
+            counts[node + 1] += counts[node]
+        offsets = array('i', counts)
+        targets = array('i', [0] * len(edges))
+        position = list(counts[:-1])
+        for source, target in sorted(edges):
+            targets[position[source]] = target
+            position[source] += 1
+        return offsets, targets
+
+    def neighbours(self, node, reverse = False):
+        offsets, targets = (self.reverse_offsets, self.reverse_targets) if reverse else (self.offsets, self.targets)
+        return targets[offsets[node]:offsets[node + 1]]
+
+    def bfs(self, node, reverse = False):
+        seen = {node}
+        queue = deque([node])
+        while queue:
+            for neighbour in self.neighbours(queue.popleft(), reverse):
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    queue.append(neighbour)
+        seen.discard(node)
+        return frozenset(seen)
+
+    def reachable(self, node, reverse = False):
+        # reverse=False: nodes that node can reach, reverse=True: nodes that can reach node.
+        closure = self.reverse_closure if reverse else self.closure
+        if closure is not None:
+            component = self.component[node]
+            # Nodes of the same component reach each other.
+            nodes = [member for member in self.members(component) if member != node]
+            for other in closure[component]:
+                nodes.extend(self.members(other))
+            return frozenset(nodes)
+        if (node, reverse) not in self.cache:
+            self.cache[(node, reverse)] = self.bfs(node, reverse)
+        return self.cache[(node, reverse)]
+
+    def components(self, reverse = False):
+        # Iterative Tarjan, components come out in reverse topological order.
+        index = {}
+        lowlink = {}
+        on_stack = set()
+        stack = []
+        components = []
+        counter = 0
+        for start in range(len(self.nodes)):
+            if start in index:
+                continue
+            work = [(start, 0)]
+            while work:
+                node, position = work.pop()
+                if position == 0:
+                    index[node] = lowlink[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    on_stack.add(node)
+                neighbours = self.neighbours(node, reverse)
+                if position < len(neighbours):
+                    work.append((node, position + 1))
+                    neighbour = neighbours[position]
+                    if neighbour not in index:
+                        work.append((neighbour, 0))
+                    elif neighbour in on_stack:
+                        lowlink[node] = min(lowlink[node], index[neighbour])
+                    continue
+                if work and work[-1][0] != node:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+        return components
+
+    def members(self, component):
+        return self.component_members[self.component_offsets[component]:self.component_offsets[component + 1]]
+
+    def compute_closure(self, order, reverse = False):
+        # order must list every component after all the components it has edges to.
+        closure = [None] * (len(self.component_offsets) - 1)
+        for component in order:
+            reached = set()
+            for member in self.members(component):
+                for neighbour in self.neighbours(member, reverse):
+                    other = self.component[neighbour]
+                    if other != component and other not in reached:
+                        reached.add(other)
+                        reached.update(closure[other])
+            closure[component] = array('i', sorted(reached))
+        return closure
+
+    def precompute(self):
+        # Tarjan returns the components in reverse topological order of the edges, which
+        # is the order the forward closure needs; the reverse closure needs the opposite.
+        components = self.components()
+        self.component = array('i', [0] * len(self.nodes))
+        self.component_offsets = array('i', [0])
+        self.component_members = array('i')
+        for index, component in enumerate(components):
+            for member in component:
+                self.component[member] = index
+            self.component_members.extend(sorted(component))
+            self.component_offsets.append(len(self.component_members))
+        self.closure = self.compute_closure(range(len(components)))
+        self.reverse_closure = self.compute_closure(range(len(components) - 1, -1, -1), reverse = True)
+        return self
+
+    def find(self, name):
+        # Accepts a node name as written in the graph, or a role name.
+        if name in self.node_index:
+            return [self.node_index[name]]
+        return sorted(node for node in self.roles if self.nodes[node].rsplit('/', 1)[-1] == name)
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump({'nodes': self.nodes, 'roles': self.roles,
+                         'offsets': self.offsets, 'targets': self.targets,
+                         'reverse_offsets': self.reverse_offsets, 'reverse_targets': self.reverse_targets,
+                         'component': self.component, 'component_offsets': self.component_offsets,
+                         'component_members': self.component_members,
+                         'closure': self.closure, 'reverse_closure': self.reverse_closure}, f, protocol = pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        graph = cls()
+        with open(filename, 'rb') as f:
+            state = pickle.load(f)
+        graph.nodes = state['nodes']
+        graph.node_index = dict((name, node) for node, name in enumerate(graph.nodes))
+        graph.roles = state['roles']
+        graph.offsets = state['offsets']
+        graph.targets = state['targets']
+        graph.reverse_offsets = state['reverse_offsets']
+        graph.reverse_targets = state['reverse_targets']
+        graph.component = state['component']
+        graph.component_offsets = state['component_offsets']
+        graph.component_members = state['component_members']
+        graph.closure = state['closure']
+        graph.reverse_closure = state['reverse_closure']
+        return graph
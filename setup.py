@@ -45,6 +45,7 @@ setup(name='iamctl',
       author_email='maddulap@amazon.com, souvanga@amazon.com',
       license='Apache-2.0',
       install_requires=requires,
+      extras_require={'pandas': ['numpy', 'pandas']},
       packages=['iamctl'],
       zip_safe=False,
       scripts=['bin/iamctl'],